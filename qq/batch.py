@@ -0,0 +1,205 @@
+"""
+Batch explanations: split a script or history file into top-level commands and
+explain them concurrently, yielding results in input order.
+"""
+
+import asyncio
+import re
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from qq.offline import CLOSERS, LEADERS, OPENERS
+
+_CONTINUATIONS = ("\\", "|", "&&", "||")
+_HEREDOC = re.compile(r"<<-?\s*(['\"]?)(\w+)\1")
+_ZSH_ENTRY = re.compile(r": \d+:\d+;")
+_TOKEN = re.compile(
+    r"""
+    (?P<space>[ \t\r]+|\\\n)
+    | (?P<separator>;;?|&&?|\|\|?|[\n()])
+    | (?P<comment>\#[^\n]*)
+    | (?P<word>(?:[^\s;&|()'"\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")+)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def _depth(command: str) -> Optional[int]:
+    """
+    Net nesting of compound commands (if/fi, for/done, case/esac, {/}) in
+    command, or None if it doesn't tokenize yet (an open quote). Reserved
+    words only count where a command starts, so `grep -rn if src/` opens
+    nothing.
+    """
+    depth = 0
+    leading = True
+    pos = 0
+    while pos < len(command):
+        token = _TOKEN.match(command, pos)
+        if token is None:
+            return None
+        pos = token.end()
+        match token.lastgroup:
+            case "separator":
+                leading = True
+            case "word":
+                word = token.group()
+                if leading and word in OPENERS:
+                    depth += 1
+                elif leading and word in CLOSERS:
+                    depth -= 1
+                leading = leading and word in LEADERS
+    return depth
+
+
+def split_commands(text: str) -> List[str]:
+    """
+    Split a shell script or a file of one-command-per-line into top-level
+    commands. Comments and blank lines are dropped; line continuations, open
+    quotes, heredocs and compound commands are kept together.
+    """
+    commands = []
+    pending = []
+    heredoc = None
+    for line in text.splitlines():
+        if heredoc is not None:
+            pending.append(line)
+            if line.strip() == heredoc:
+                heredoc = None
+            else:
+                continue
+        else:
+            stripped = line.strip()
+            if not pending and (not stripped or stripped.startswith("#")):
+                continue
+            pending.append(line)
+            match = _HEREDOC.search(line)
+            if match:
+                heredoc = match.group(2)
+                continue
+
+        command = "\n".join(pending).strip()
+        if command.endswith(_CONTINUATIONS):
+            continue
+        depth = _depth(command)
+        if depth is None or depth > 0:
+            continue
+        commands.append(command)
+        pending = []
+
+    if pending:
+        commands.append("\n".join(pending).strip())
+    return commands
+
+
+def _unmetafy(data: bytes) -> bytes:
+    """zsh stores bytes 0x83-0x9f (and NUL) in history as 0x83, byte ^ 0x20"""
+    if b"\x83" not in data:
+        return data
+    out = bytearray()
+    it = iter(data)
+    for byte in it:
+        out.append(next(it, 0x20) ^ 0x20 if byte == 0x83 else byte)
+    return bytes(out)
+
+
+def _extended_history(text: str) -> bool:
+    """Whether text is a zsh history with timestamps (`: <start>:<elapsed>;command`)"""
+    return _ZSH_ENTRY.match(text.lstrip()) is not None
+
+
+def decode_history(data: bytes, zsh: Optional[bool] = None) -> str:
+    """
+    A file's text, undoing zsh's metafication if it's a zsh history; by
+    default that's if it has extended history's timestamps
+    """
+    if zsh is None:
+        zsh = _extended_history(data[:100].decode("latin-1"))
+    if zsh:
+        data = _unmetafy(data)
+    return data.decode("utf-8", errors="replace")
+
+
+def history_entries(text: str) -> Iterator[str]:
+    """Commands in a zsh (plain or extended) or bash history, oldest first"""
+    entry = None
+    for line in text.splitlines():
+        if entry is not None:
+            # zsh keeps multi-line commands as lines ending in a backslash
+            entry += "\n" + line
+        elif _ZSH_ENTRY.match(line):
+            entry = line.split(";", 1)[1]
+        elif line.startswith("#") and line[1:].isdigit():
+            # bash's HISTTIMEFORMAT timestamps
+            continue
+        else:
+            entry = line
+        if entry.endswith("\\"):
+            entry = entry[:-1]
+            continue
+        if entry.strip():
+            yield entry.strip()
+        entry = None
+
+
+def parse(text: str) -> List[str]:
+    """
+    The commands in a script or history file: a zsh extended history's
+    entries without their timestamps, or else top-level commands
+    """
+    if _extended_history(text):
+        return list(history_entries(text))
+    return split_commands(text)
+
+
+def dedupe(commands: List[str]) -> List[str]:
+    return list(dict.fromkeys(commands))
+
+
+async def run(
+    commands: List[str],
+    lookup: Callable[[str], Optional[str]],
+    fetch: Callable[[str], Awaitable[str]],
+    jobs: int = 4,
+) -> AsyncIterator[Tuple[str, Union[str, Exception], bool]]:
+    """
+    Explain every command, yielding (command, explanation, cached) in input
+    order. Cached explanations come from lookup(); the rest are fetched
+    concurrently with up to `jobs` in flight. A fetch that fails gives its
+    exception as the explanation, and the rest carry on.
+    """
+    semaphore = asyncio.Semaphore(max(1, jobs))
+
+    async def limited_fetch(command: str) -> Union[str, Exception]:
+        async with semaphore:
+            try:
+                return await fetch(command)
+            except Exception as e:
+                return e
+
+    pending = []
+    for command in commands:
+        hit = lookup(command)
+        if hit is not None:
+            pending.append((command, hit, None))
+        else:
+            pending.append((command, None, asyncio.create_task(limited_fetch(command))))
+
+    try:
+        for command, hit, task in pending:
+            if task is None:
+                yield command, hit, True
+            else:
+                yield command, await task, False
+    finally:
+        for _, _, task in pending:
+            if task is not None:
+                task.cancel()
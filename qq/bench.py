@@ -0,0 +1,388 @@
+"""
+qq bench: measure qq's own overhead, separately from the provider's.
+
+A local OpenAI-compatible stub server streams a canned response with
+configurable latency and token rate, so runs need no network access and no API
+key. Results are printed as JSON so they can be tracked across releases.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import aclosing, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from qq import cache
+from qq.engine import Engine
+from qq.stream import CommandParser
+
+BENCH_MODEL = "openai/qq-bench"
+BENCH_COMMAND = "ffmpeg -i IMG_8011.MOV -vcodec libx264 -crf 23 -preset fast output.mov"
+
+EXPLANATION = """ffmpeg - A multimedia framework for handling video, audio, and other multimedia files and streams
+    -i IMG_8011.MOV - Input file, specified as 'IMG_8011.MOV'
+    -vcodec libx264 - Use the H.264 video codec for encoding
+    -crf 23 - Set the Constant Rate Factor (CRF) to 23, balancing quality and file size
+    -preset fast - Use the 'fast' preset for encoding speed
+    output.mov - Output file, specified as 'output.mov'
+This command converts 'IMG_8011.MOV' to 'output.mov' using H.264 with the given quality and speed settings."""
+
+GENERATION = "Here you go:\n<command>ffmpeg -i video_file.mp4 -vn -ar 44100 -ac 2 -b:a 192k output_audio.mp3</command>\nThis extracts the audio track as a 192 kbps mp3."
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into roughly token-sized pieces, the way providers stream it"""
+    pieces = []
+    for i in range(0, len(text), 4):
+        pieces.append(text[i : i + 4])
+    return pieces
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._json({"object": "list", "data": [{"id": "qq-bench", "object": "model"}]})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        system = body.get("messages", [{}])[0].get("content", "")
+        text = GENERATION if "<command>" in str(system) else EXPLANATION
+        tokens = tokenize(text)
+
+        time.sleep(self.server.latency)
+        if not body.get("stream"):
+            self._json(
+                {
+                    "id": "bench",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+                }
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        interval = 1.0 / self.server.token_rate if self.server.token_rate else 0
+        try:
+            for i, token in enumerate(tokens):
+                if i and interval:
+                    time.sleep(interval)
+                self._event(body, {"content": token}, None)
+            self._event(body, {}, "stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+    def _event(self, body, delta, finish_reason):
+        chunk = {
+            "id": "bench",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.flush()
+
+    def _json(self, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubServer:
+    """OpenAI-compatible server on localhost streaming canned responses"""
+
+    def __init__(self, latency: float = 0.0, token_rate: float = 0.0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.token_rate = token_rate
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _CannedEngine(Engine):
+    """An Engine whose responses come from memory, to time qq's side alone"""
+
+    def __init__(self, chunks: List[str], **kwargs):
+        super().__init__(BENCH_MODEL, use_daemon=False, **kwargs)
+        self.chunks = chunks
+
+    async def _source(self, kwargs, record):
+        for chunk in self.chunks:
+            yield chunk
+        record.report(0, 0, len(self.chunks))
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+    return {
+        "runs": len(samples),
+        "median_ms": statistics.median(samples) * 1000,
+        "min_ms": samples[0] * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def _qq(*argv: str, env: Dict[str, str] = None) -> float:
+    """Wall time of one `qq ...` invocation in a fresh interpreter"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "qq.main", *argv],
+        cwd=root,
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def bench_cold_start(runs: int) -> dict:
+    return _summary([_qq("--help") for _ in range(runs)])
+
+
+def bench_cache_hit(runs: int) -> dict:
+    """End-to-end `qq <command>` answered from a pre-populated cache"""
+    from qq.main import _explain_request, build_parser
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {"QQ_CACHE_DIR": tmp}
+        argv = ["--no-daemon", "--model", BENCH_MODEL, BENCH_COMMAND]
+        args = build_parser().parse_args(argv)
+        # the key depends on what's in the cache dir (e.g. a `qq index`), so
+        # compute it against the same one the runs will see
+        saved, os.environ["QQ_CACHE_DIR"] = os.environ.get("QQ_CACHE_DIR"), tmp
+        try:
+            key, _ = _explain_request(BENCH_COMMAND, args, BENCH_MODEL)
+        finally:
+            if saved is None:
+                del os.environ["QQ_CACHE_DIR"]
+            else:
+                os.environ["QQ_CACHE_DIR"] = saved
+        cache.Cache(os.path.join(tmp, "cache.sqlite")).put(key, EXPLANATION)
+        return _summary([_qq(*argv, env=env) for _ in range(runs)])
+
+
+def bench_render(runs: int) -> dict:
+    """Per-chunk overhead of explain() printing a stream, with no network"""
+    from qq.main import build_parser, explain
+
+    chunks = tokenize(EXPLANATION) * 10
+    args = build_parser().parse_args(["--no-cache", BENCH_COMMAND])
+    samples = []
+    for _ in range(runs):
+        llm = _CannedEngine(chunks)
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            stderr, sys.stderr = sys.stderr, io.StringIO()
+            try:
+                start = time.perf_counter()
+                asyncio.run(explain(llm, BENCH_COMMAND, args))
+                samples.append(time.perf_counter() - start)
+            finally:
+                sys.stderr = stderr
+    result = _summary(samples)
+    result["chunks"] = len(chunks)
+    result["per_chunk_us"] = result["median_ms"] * 1000 / len(chunks)
+    return result
+
+
+def bench_extract(runs: int) -> dict:
+    """<command> extraction cost over a streamed generate response"""
+    chunks = tokenize(GENERATION)
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in range(100):
+            parser = CommandParser()
+            for chunk in chunks:
+                parser.feed(chunk)
+                if parser.closed:
+                    break
+        samples.append((time.perf_counter() - start) / 100)
+    result = _summary(samples)
+    result["chunks"] = len(chunks)
+    result["per_chunk_us"] = result["median_ms"] * 1000 / len(chunks)
+    return result
+
+
+# how fast each simulated terminal takes output, in bytes/s (0 = no limit)
+TERMINALS = {"local": 0, "ssh": 125_000, "slow": 9_600}
+
+
+def _terminal(rate: float):
+    """A pipe drained at rate by a thread; returns its write end and a read count"""
+    read_fd, write_fd = os.pipe()
+    reads = [0]
+
+    def drain():
+        with os.fdopen(read_fd, "rb", buffering=0) as fp:
+            while data := fp.read(65536):
+                reads[0] += 1
+                if rate:
+                    time.sleep(len(data) / rate)
+
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+    return write_fd, thread, reads
+
+
+def bench_terminal(runs: int, token_rate: float) -> dict:
+    """
+    Write syscalls, terminal reads and rendering CPU time for one streamed
+    response, writing each chunk as it comes (window 0) vs coalesced
+    """
+    from qq.highlight import colorize
+    from qq.render import WINDOW, Renderer
+
+    chunks = tokenize(colorize(EXPLANATION, True))
+    delay = 1 / token_rate if token_rate else 0
+
+    async def feed(out: Renderer) -> None:
+        for chunk in chunks:
+            out.write(chunk)
+            await asyncio.sleep(delay)
+
+    results = {}
+    for terminal, rate in TERMINALS.items():
+        results[terminal] = {}
+        for mode, window in (("per_chunk", 0), ("coalesced", WINDOW)):
+            writes, reads, cpu = [], [], []
+            for _ in range(runs):
+                write_fd, thread, count = _terminal(rate)
+                with os.fdopen(write_fd, "w") as fp:
+                    out = Renderer(fp, window=window)
+                    start = time.thread_time()
+                    asyncio.run(feed(out))
+                    out.close()
+                    cpu.append(time.thread_time() - start)
+                thread.join()
+                writes.append(out.writes)
+                reads.append(count[0])
+            results[terminal][mode] = {
+                "writes": statistics.median(writes),
+                "terminal_reads": statistics.median(reads),
+                "cpu_ms": statistics.median(cpu) * 1000,
+            }
+    results["chunks"] = len(chunks)
+    return results
+
+
+def bench_stream(runs: int, latency: float, token_rate: float) -> dict:
+    """Time to first byte and total time through litellm against the stub"""
+    try:
+        import litellm  # noqa: F401
+    except ImportError:
+        return {"skipped": "litellm is not installed"}
+
+    async def once(url: str):
+        llm = Engine(BENCH_MODEL, use_daemon=False, api_base=url, api_key="bench")
+        messages = [{"role": "system", "content": "bench"}, {"role": "user", "content": BENCH_COMMAND}]
+        start = time.perf_counter()
+        first = None
+        async with aclosing(llm.stream(messages)) as stream:
+            async for _ in stream:
+                if first is None:
+                    first = time.perf_counter() - start
+        return first, time.perf_counter() - start
+
+    with StubServer(latency, token_rate) as stub:
+        asyncio.run(once(stub.url))  # warm up imports and connections
+        results = [asyncio.run(once(stub.url)) for _ in range(runs)]
+
+    ttfb = _summary([r[0] for r in results])
+    ttfb["overhead_ms"] = ttfb["median_ms"] - latency * 1000
+    return {"ttfb": ttfb, "total": _summary([r[1] for r in results])}
+
+
+def main(argv) -> None:
+    """qq bench"""
+    parser = argparse.ArgumentParser(
+        prog="qq bench", description="Benchmark qq's overhead against a local stub LLM"
+    )
+    parser.add_argument("--runs", type=int, default=5, help="Samples per measurement")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.2,
+        help="Stub server delay before the first token, in seconds",
+    )
+    parser.add_argument(
+        "--token-rate",
+        type=float,
+        default=200,
+        help="Stub server tokens per second (0 = as fast as possible)",
+    )
+    parser.add_argument(
+        "--only",
+        choices=["cold_start", "cache_hit", "render", "terminal", "extract", "stream"],
+        action="append",
+        help="Run only these measurements (repeatable)",
+    )
+    args = parser.parse_args(argv)
+
+    benches = {
+        "cold_start": lambda: bench_cold_start(args.runs),
+        "cache_hit": lambda: bench_cache_hit(args.runs),
+        "render": lambda: bench_render(args.runs),
+        "terminal": lambda: bench_terminal(args.runs, args.token_rate),
+        "extract": lambda: bench_extract(args.runs),
+        "stream": lambda: bench_stream(args.runs, args.latency, args.token_rate),
+    }
+    results = {
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "stub": {"latency": args.latency, "token_rate": args.token_rate},
+    }
+    for name, bench in benches.items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = bench()
+    print(json.dumps(results, indent=2))
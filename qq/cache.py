@@ -0,0 +1,209 @@
+"""
+Content-addressed on-disk cache for LLM output.
+
+Entries are keyed by a hash of everything that affects the response (the
+normalized query, model, temperature, prompt hash, ...) and live in
+a single sqlite database under the user cache dir. The database is bounded in
+size with LRU eviction and entries expire after a TTL.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+def cache_dir() -> str:
+    """Per-user cache directory for qq, honoring QQ_CACHE_DIR and XDG_CACHE_HOME"""
+    if "QQ_CACHE_DIR" in os.environ:
+        return os.environ["QQ_CACHE_DIR"]
+    if sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "qq")
+
+
+@contextmanager
+def update_json(path: str) -> Iterator[dict]:
+    """
+    The JSON object in path (empty if there's none yet) for the block to
+    change, written back atomically afterwards. Every qq process on the
+    machine may be doing the same, so it's all under an flock.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(path) as fp:
+                    state = json.load(fp)
+            except (OSError, ValueError):
+                state = {}
+            yield state
+            tmp = f"{path}.{os.getpid()}"
+            with open(tmp, "w") as fp:
+                json.dump(state, fp)
+            os.replace(tmp, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def normalize(query: str) -> str:
+    """Collapse whitespace so trivially different spellings share an entry"""
+    return " ".join(query.split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def make_key(*parts) -> str:
+    return text_hash("\0".join(str(p) for p in parts))
+
+
+class Cache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        ttl: float = DEFAULT_TTL,
+    ):
+        if path is None:
+            os.makedirs(cache_dir(), exist_ok=True)
+            path = os.path.join(cache_dir(), "cache.sqlite")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(_SCHEMA)
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.db.execute(
+            "SELECT value, created FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, created = row
+        now = time.time()
+        if now - created > self.ttl:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        self.db.execute(
+            "UPDATE entries SET accessed = ?, hits = hits + 1 WHERE key = ?",
+            (now, key),
+        )
+        return value
+
+    def has(self, key: str) -> bool:
+        """Whether key has a live entry, without counting it as a hit or a use"""
+        row = self.db.execute(
+            "SELECT created FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created, accessed)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value.encode()), now, now),
+        )
+        self._evict()
+
+    def _evict(self) -> int:
+        """Drop least recently used entries until we're under max_bytes"""
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        removed = 0
+        if total <= self.max_bytes:
+            return removed
+        for key, size in self.db.execute(
+            "SELECT key, size FROM entries ORDER BY accessed ASC"
+        ).fetchall():
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            removed += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+        return removed
+
+    def prune(self) -> int:
+        """Remove expired entries and enforce the size bound"""
+        cur = self.db.execute(
+            "DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,)
+        )
+        removed = cur.rowcount + self._evict()
+        self.db.execute("VACUUM")
+        return removed
+
+    def clear(self) -> int:
+        removed = self.db.execute("DELETE FROM entries").rowcount
+        self.db.execute("VACUUM")
+        return removed
+
+    def stats(self) -> dict:
+        entries, size, hits, oldest = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0),"
+            " MIN(created) FROM entries"
+        ).fetchone()
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "ttl": self.ttl,
+            "oldest": oldest,
+        }
+
+
+def open_cache() -> Optional[Cache]:
+    """Open the default cache, or None if it can't be used (read-only home etc.)"""
+    try:
+        return Cache()
+    except (OSError, sqlite3.Error) as e:
+        print(f"\033[1;33mcache disabled: {e}\033[0m", file=sys.stderr)
+        return None
+
+
+def main(argv) -> None:
+    """qq cache stats|prune|clear"""
+    parser = argparse.ArgumentParser(prog="qq cache", description="Manage the qq cache")
+    parser.add_argument("action", choices=["stats", "prune", "clear"])
+    args = parser.parse_args(argv)
+
+    cache = Cache()
+    match args.action:
+        case "stats":
+            stats = cache.stats()
+            age = time.time() - stats["oldest"] if stats["oldest"] else 0
+            print(f"path:    {stats['path']}")
+            print(f"entries: {stats['entries']}")
+            print(f"size:    {stats['bytes'] / 1024:.1f} KiB of {stats['max_bytes'] / 1024 / 1024:.0f} MiB")
+            print(f"hits:    {stats['hits']}")
+            print(f"oldest:  {age / 86400:.1f} days (ttl {stats['ttl'] / 86400:.0f} days)")
+        case "prune":
+            print(f"pruned {cache.prune()} entries")
+        case "clear":
+            print(f"cleared {cache.clear()} entries")
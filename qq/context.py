@@ -0,0 +1,81 @@
+"""
+Conversation state for generate() sessions.
+
+Each (r)eprompt used to resend the whole transcript, so cost and latency grew
+with every turn. A Conversation sends just the system prompt, the original
+request with a compact list of later refinements, the latest command, and the
+new refinement; the oldest refinements are dropped once a token ceiling is hit.
+"""
+
+from typing import Dict, List, Optional
+
+DEFAULT_MAX_TOKENS = 1000
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting"""
+    return len(text) // 4 + 1
+
+
+def _message_tokens(messages: List[Dict]) -> int:
+    total = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            content = "".join(block.get("text", "") for block in content)
+        total += estimate_tokens(content)
+    return total
+
+
+class Conversation:
+    def __init__(self, system: Dict, max_tokens: int = DEFAULT_MAX_TOKENS):
+        self.system = system
+        self.max_tokens = max_tokens
+        self.requests: List[str] = []
+        self.command: Optional[str] = None
+        # what resending the full transcript would have cost, for --debug
+        self.transcript: List[Dict] = [system]
+
+    def ask(self, query: str) -> None:
+        self.requests.append(query)
+        self.transcript.append({"role": "user", "content": query})
+
+    def answer(self, command: str) -> None:
+        self.command = command
+        self.transcript.append(
+            {"role": "assistant", "content": f"<command>{command}</command>"}
+        )
+
+    def _history(self, refinements: List[str], omitted: int) -> str:
+        history = self.requests[0]
+        if refinements or omitted:
+            history += "\n\nRefinements so far:"
+            if omitted:
+                history += f"\n- ({omitted} earlier refinements omitted)"
+            for refinement in refinements:
+                history += f"\n- {refinement}"
+        return history
+
+    def messages(self) -> List[Dict]:
+        if len(self.requests) == 1 or self.command is None:
+            return [self.system, {"role": "user", "content": self.requests[-1]}]
+
+        refinements = self.requests[1:-1]
+        omitted = 0
+        while True:
+            messages = [
+                self.system,
+                {"role": "user", "content": self._history(refinements, omitted)},
+                {"role": "assistant", "content": f"<command>{self.command}</command>"},
+                {"role": "user", "content": self.requests[-1]},
+            ]
+            if not refinements or _message_tokens(messages[1:]) <= self.max_tokens:
+                return messages
+            refinements = refinements[1:]
+            omitted += 1
+
+    def savings(self) -> str:
+        """--debug readout comparing this turn's context to the full transcript"""
+        sent = _message_tokens(self.messages())
+        full = _message_tokens(self.transcript)
+        return f"context ~{sent} tokens, full transcript ~{full}, saved ~{max(0, full - sent)}"
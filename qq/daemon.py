@@ -0,0 +1,310 @@
+"""
+Optional background daemon that keeps litellm warm.
+
+`qq daemon start` spawns a server holding a pre-imported litellm and a pooled
+keep-alive HTTP client, listening on a Unix domain socket. The qq CLI forwards
+completion requests to it and streams tokens back, falling back to running the
+request in-process when no daemon is listening.
+
+The protocol is newline-delimited JSON: the client sends one request object
+and the server answers with {"delta": ...} lines followed by a final
+{"done": true, "metrics": ...} or {"error": ...} line.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from qq import metrics
+from qq.cache import cache_dir
+from qq.metrics import RequestMetrics
+
+
+def socket_path() -> str:
+    if "QQ_SOCKET" in os.environ:
+        return os.environ["QQ_SOCKET"]
+    base = os.environ.get("XDG_RUNTIME_DIR") or cache_dir()
+    return os.path.join(base, "qq.sock")
+
+
+class NotRunning(ConnectionError):
+    pass
+
+
+def _connect(timeout: float = None) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path())
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _send(fp, obj) -> None:
+    fp.write(json.dumps(obj).encode() + b"\n")
+    fp.flush()
+
+
+def request(obj, timeout: float = None):
+    """Send one request to the daemon and yield each response message"""
+    with _connect(timeout) as sock, sock.makefile("rwb") as fp:
+        _send(fp, obj)
+        for line in fp:
+            yield json.loads(line)
+
+
+def is_running() -> bool:
+    try:
+        return any(msg.get("ok") for msg in request({"op": "ping"}, timeout=1))
+    except OSError:
+        return False
+
+
+async def completion(kwargs: dict, done: dict):
+    """
+    Stream content deltas for a completion served by the daemon, filling in
+    `done` with the final message (which carries usage and cost). Raises NotRunning
+    before yielding anything if no daemon is listening, so the caller can fall
+    back to running in-process.
+
+    Closing the stream early half-closes the socket, which tells the daemon to
+    stop generating; it still answers with the cost of what was produced.
+    """
+    try:
+        reader, writer = await asyncio.open_unix_connection(socket_path())
+    except OSError as e:
+        raise NotRunning(f"no qq daemon at {socket_path()}") from e
+
+    try:
+        writer.write(json.dumps({"op": "completion", "kwargs": kwargs}).encode() + b"\n")
+        await writer.drain()
+        while line := await reader.readline():
+            msg = json.loads(line)
+            if "error" in msg:
+                raise RuntimeError(msg["error"])
+            if msg.get("done"):
+                done.update(msg)
+                return
+            yield msg["delta"]
+        raise RuntimeError("qq daemon closed the connection mid-response")
+    finally:
+        if not done:
+            try:
+                writer.write_eof()
+                async with asyncio.timeout(2):
+                    while line := await reader.readline():
+                        msg = json.loads(line)
+                        if msg.get("done"):
+                            done.update(msg)
+                            break
+            except (OSError, TimeoutError, ValueError):
+                pass
+        writer.close()
+
+
+class _Server:
+    def __init__(self, litellm):
+        self.litellm = litellm
+        self.stopped = asyncio.Event()
+
+    async def handle(self, reader, writer):
+        async def send(obj):
+            writer.write(json.dumps(obj).encode() + b"\n")
+            await writer.drain()
+
+        hangup = None
+        try:
+            req = json.loads(await reader.readline())
+            # the client half-closes to cancel; anything else it sends is ignored
+            hangup = asyncio.ensure_future(reader.read())
+            match req.get("op"):
+                case "ping":
+                    await send({"ok": True, "pid": os.getpid()})
+                case "stop":
+                    await send({"ok": True})
+                    self.stopped.set()
+                case "completion":
+                    await self.completion(req["kwargs"], send, hangup)
+                case op:
+                    await send({"error": f"unknown op {op!r}"})
+        except (ValueError, ConnectionError):
+            # garbage request, or the client went away (ctrl-c)
+            pass
+        finally:
+            if hangup is not None:
+                hangup.cancel()
+            writer.close()
+
+    async def completion(self, kwargs, send, hangup):
+        litellm = self.litellm
+        # keep the client's id, so litellm's callback lands on this record
+        record = RequestMetrics(kwargs["model"])
+        record.id = kwargs.setdefault("litellm_call_id", record.id)
+        metrics.track(record)
+        chunks = []
+        try:
+            response = await litellm.acompletion(**kwargs)
+        except Exception as e:
+            await send({"error": str(e)})
+            return
+
+        finished = False
+        try:
+            async for chunk in response:
+                chunks.append(chunk)
+                if hangup.done():
+                    break
+                content = chunk.choices[0].delta.content
+                if content:
+                    await send({"delta": content})
+            else:
+                finished = True
+        except ConnectionError:
+            raise
+        except Exception as e:
+            await send({"error": str(e)})
+            return
+        finally:
+            close = getattr(response, "aclose", None)
+            if close is not None:
+                await close()
+
+        # litellm only reports on streams that run to the end
+        if not (finished and await record.settle()):
+            try:
+                response = litellm.stream_chunk_builder(chunks, messages=kwargs["messages"])
+                record.report(
+                    cost=litellm.completion_cost(completion_response=response),
+                    prompt_tokens=response.usage.prompt_tokens,
+                    completion_tokens=response.usage.completion_tokens,
+                    cached_tokens=metrics.cached_tokens(response.usage),
+                )
+            except Exception:
+                pass
+        await send(
+            {
+                "done": True,
+                "metrics": {
+                    "cost": record.cost,
+                    "prompt_tokens": record.prompt_tokens,
+                    "completion_tokens": record.completion_tokens,
+                    "cached_tokens": record.cached_tokens,
+                },
+            }
+        )
+
+
+async def _serve(path: str) -> None:
+    import httpx
+    import litellm
+
+    from qq.logger import MetricsLogger
+
+    litellm.callbacks = [MetricsLogger()]
+
+    # one pooled client for the life of the daemon so keep-alive connections
+    # (and their TLS sessions) to the provider are reused across requests
+    litellm.aclient_session = httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=300),
+        timeout=httpx.Timeout(600, connect=10),
+    )
+
+    handler = _Server(litellm)
+    # the socket hands out the daemon's API keys, so only we may connect
+    old_umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(handler.handle, path, limit=2**24)
+    finally:
+        os.umask(old_umask)
+
+    print(f"qq daemon listening on {path} (pid {os.getpid()})", file=sys.stderr)
+    async with server:
+        await handler.stopped.wait()
+
+
+def serve() -> None:
+    """Run the daemon in the foreground until stopped"""
+    path = socket_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        if is_running():
+            print(f"qq daemon already running at {path}", file=sys.stderr)
+            sys.exit(1)
+        os.unlink(path)
+
+    try:
+        asyncio.run(_serve(path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def start() -> None:
+    """Spawn a detached daemon and wait for it to come up"""
+    if is_running():
+        print(f"qq daemon already running at {socket_path()}")
+        return
+
+    os.makedirs(cache_dir(), exist_ok=True)
+    log = os.path.join(cache_dir(), "daemon.log")
+    with open(log, "ab") as fp:
+        subprocess.Popen(
+            [sys.executable, "-m", "qq.main", "daemon", "run"],
+            stdin=subprocess.DEVNULL,
+            stdout=fp,
+            stderr=fp,
+            start_new_session=True,
+        )
+
+    # litellm is slow to import, give it a while
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if is_running():
+            print(f"qq daemon started at {socket_path()}")
+            return
+        time.sleep(0.1)
+    print(f"qq daemon failed to start, see {log}", file=sys.stderr)
+    sys.exit(1)
+
+
+def main(argv) -> None:
+    """qq daemon start|run|stop|status"""
+    parser = argparse.ArgumentParser(
+        prog="qq daemon", description="Manage the background qq daemon"
+    )
+    parser.add_argument(
+        "action",
+        nargs="?",
+        default="start",
+        choices=["start", "run", "stop", "status"],
+        help="start in the background (default), run in the foreground, stop, or check status",
+    )
+    args = parser.parse_args(argv)
+
+    match args.action:
+        case "start":
+            start()
+        case "run":
+            serve()
+        case "stop":
+            try:
+                list(request({"op": "stop"}, timeout=5))
+                print("qq daemon stopped")
+            except OSError:
+                print("qq daemon is not running")
+        case "status":
+            try:
+                msg = next(request({"op": "ping"}, timeout=1))
+                print(f"qq daemon running at {socket_path()} (pid {msg['pid']})")
+            except OSError:
+                print("qq daemon is not running")
+                sys.exit(1)
@@ -0,0 +1,219 @@
+"""
+Async completion engine.
+
+All requests go through Engine.stream(), an async generator of content deltas
+built on litellm.acompletion (or the qq daemon when one is running), so the CLI
+can drive several requests concurrently from one event loop. Closing the
+generator early (break, cancellation, ctrl-c) closes the underlying stream.
+"""
+
+import asyncio
+from contextlib import aclosing
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from qq import daemon
+from qq.metrics import RequestMetrics, Session
+
+# litellm takes 1-3s to import, so it is loaded on first use (see _load_litellm)
+# rather than at import time; `qq --help` and argument errors shouldn't pay for it
+_litellm = None
+
+
+def _load_litellm():
+    """Import litellm and install the metrics callback the first time it's needed"""
+    global _litellm
+    if _litellm is None:
+        import litellm
+
+        from qq.logger import MetricsLogger
+
+        litellm.callbacks = [MetricsLogger()]
+        _litellm = litellm
+    return _litellm
+
+
+async def _close(response) -> None:
+    """Best-effort close of a litellm stream so the HTTP response is released"""
+    for target in (response, getattr(response, "completion_stream", None)):
+        close = getattr(target, "aclose", None)
+        if close is not None:
+            try:
+                await close()
+            except Exception:
+                pass
+            return
+
+
+def _estimate(record: RequestMetrics, kwargs: Dict, text: str) -> None:
+    """Fill in usage and cost from our side, for streams litellm never reports on"""
+    litellm = _load_litellm()
+    try:
+        record.report(
+            cost=litellm.completion_cost(
+                model=kwargs["model"], messages=kwargs["messages"], completion=text
+            ),
+            prompt_tokens=litellm.token_counter(
+                model=kwargs["model"], messages=kwargs["messages"]
+            ),
+            completion_tokens=litellm.token_counter(model=kwargs["model"], text=text),
+        )
+    except Exception:
+        record.reported = True
+
+
+async def completion(record: RequestMetrics, **kwargs) -> AsyncIterator[str]:
+    """Stream content deltas from litellm.acompletion in this process"""
+    response = await _load_litellm().acompletion(**kwargs)
+    text = ""
+    finished = False
+    try:
+        async for chunk in response:
+            content = chunk.choices[0].delta.content
+            if content:
+                text += content
+                yield content
+        finished = True
+    finally:
+        await _close(response)
+        # litellm only reports on streams that run to the end
+        if not (finished and await record.settle()):
+            _estimate(record, kwargs, text)
+
+
+class Engine:
+    """A model plus its request parameters; stream() issues one request"""
+
+    def __init__(
+        self,
+        model: str,
+        use_daemon: bool = True,
+        session: Optional[Session] = None,
+        limiter=None,
+        **params,
+    ):
+        self.model = model
+        self.use_daemon = use_daemon
+        self.session = session or Session()
+        # a qq.ratelimit.RateLimiter, if requests should queue for one
+        self.limiter = limiter
+        self.params = {"model": model, "stream": True, **params}
+
+    async def _source(self, kwargs: Dict, record: RequestMetrics) -> AsyncIterator[str]:
+        if self.use_daemon:
+            done = {}
+            try:
+                async with aclosing(daemon.completion(kwargs, done)) as stream:
+                    async for content in stream:
+                        yield content
+                return
+            except daemon.NotRunning:
+                # nothing was yielded yet, so it's safe to go in-process instead
+                pass
+            finally:
+                if done:
+                    record.report(**done["metrics"])
+
+        async with aclosing(completion(record, **kwargs)) as stream:
+            async for content in stream:
+                yield content
+
+    async def stream(
+        self,
+        messages: List[Dict],
+        sent: Optional[Callable[[], None]] = None,
+        **overrides,
+    ) -> AsyncIterator[str]:
+        """
+        Stream content deltas for messages, recording metrics for the request
+        in self.session. max_tokens is also enforced on our side for providers
+        that don't honor it, but loosely: it counts chunks, and a chunk can
+        hold several tokens, so it only stops runaway output. With a rate
+        limiter, the request first waits its turn; sent() is called once it
+        goes out.
+        """
+        kwargs = {**self.params, **overrides, "messages": messages}
+        budget = kwargs.get("max_tokens")
+        queued = 0.0
+        if self.limiter:
+            charged = self.limiter.estimate(messages, budget)
+            queued = await self.limiter.acquire(kwargs["model"], charged)
+        if sent:
+            sent()
+        record = self.session.start(kwargs["model"])
+        record.queued = queued
+        kwargs["litellm_call_id"] = record.id
+
+        used = 0
+        try:
+            async with aclosing(self._source(kwargs, record)) as source:
+                try:
+                    async for content in source:
+                        record.first_token()
+                        used += 1
+                        yield content
+                        # chunks, not tokens: a backstop, not an exact cutoff
+                        if budget and used >= budget:
+                            break
+                except GeneratorExit:
+                    # the caller hung up early (e.g. at </command>); what wasn't
+                    # generated isn't known, so there's no figure for the savings
+                    record.stopped_early = True
+                    raise
+        finally:
+            record.finish()
+            if self.limiter and record.prompt_tokens:
+                used = record.prompt_tokens + record.completion_tokens
+                self.limiter.settle(kwargs["model"], charged, used)
+
+    async def text(self, messages: List[Dict], **overrides) -> str:
+        """The whole response as one string"""
+        result = ""
+        async with aclosing(self.stream(messages, **overrides)) as stream:
+            async for content in stream:
+                result += content
+        return result
+
+
+class Prefetch:
+    """
+    Consume a stream in the background into a buffer, so it can be replayed
+    later: replay() yields everything received so far immediately and then
+    follows the rest of the stream live. Errors are deferred to replay().
+    """
+
+    def __init__(self, stream: AsyncIterator[str]):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._fill(stream))
+
+    async def _fill(self, stream: AsyncIterator[str]) -> None:
+        try:
+            async with aclosing(stream):
+                async for content in stream:
+                    self.chunks.append(content)
+                    self._changed.set()
+        except asyncio.CancelledError:
+            self.error = RuntimeError("prefetch cancelled")
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._changed.set()
+
+    async def replay(self) -> AsyncIterator[str]:
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                break
+            self._changed.clear()
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self) -> None:
+        self._task.cancel()
@@ -0,0 +1,224 @@
+"""
+Coloring explanations on our side.
+
+Models are asked for plain `<indent><fragment> - <description>` lines rather
+than ANSI codes: escapes cost several tokens apiece, not every model gets them
+right, and plain text can be cached once and shown with or without color.
+The Highlighter parses those lines as they stream in, works out each word's
+role in its fragment from its shape and position, and paints it. Records
+turns the same lines into objects for --format json/ndjson.
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+COLORS = {
+    "command": "1;34",
+    "option": "1;35",
+    "string": "1;33",
+    "argument": "1;32",
+    "operator": "1;36",
+    "redirect": "1;36",
+    "assignment": "1;36",
+}
+
+INDENT = "    "
+SEPARATOR = " - "
+
+# what a model may still send of its own accord, whole or cut off by a chunk
+_ANSI = re.compile(r"\033\[[0-?]*[ -/]*[@-~]")
+_PARTIAL_ANSI = re.compile(r"\033(?:\[[0-?]*[ -/]*)?$")
+
+# indent, fragment, then the separator; the fragment is as short as possible,
+# so `-cf - dir - ...` splits at the first separator
+_LINE = re.compile(r"^([ \t]*)(\S.*?) - ")
+# a quote opened mid-word (roles:='["a", "b"]') stays part of the word
+_WORD = re.compile(r"""(?:'[^']*'?|"[^"]*"?|[^\s'"]+)+""")
+_OPERATOR = re.compile(r"^(\|&?|&&|\|\||;|&|\(|\)|<<<)$")
+_REDIRECT = re.compile(r"^[0-9]*(>>?|<<<|<|&>|>&|>\|)\S*$")
+_ASSIGNMENT = re.compile(r"^[A-Za-z_][\w.-]*:?=")
+_SUBCOMMAND = re.compile(r"^[a-z][a-z0-9-]*$")
+
+
+def paint(text: str, role: str, color: bool) -> str:
+    return f"\033[{COLORS[role]}m{text}\033[0m" if color else text
+
+
+def depth_of(indent: str) -> int:
+    return len(indent.expandtabs(len(INDENT))) // len(INDENT)
+
+
+def parse_line(line: str) -> Optional[Tuple[int, str, str]]:
+    """(depth, fragment, description) for a fragment line, None for anything else"""
+    match = _LINE.match(line)
+    if match is None or (not match.group(1) and match.group(2).startswith("This ")):
+        # the closing summary ("This command ...") isn't a fragment
+        return None
+    return depth_of(match.group(1)), match.group(2), line[match.end() :]
+
+
+def roles(fragment: str, depth: int) -> List[Tuple[str, str]]:
+    """(word, role) for each word of a fragment"""
+    result = []
+    for i, word in enumerate(_WORD.findall(fragment)):
+        if _OPERATOR.match(word):
+            role = "operator"
+        elif _REDIRECT.match(word):
+            role = "redirect"
+        elif word[:1] in "'\"":
+            role = "string"
+        elif word.startswith("-") and len(word) > 1:
+            role = "option"
+        elif result and result[0][1] in ("option", "redirect"):
+            # the option's argument, or where the redirect goes
+            role = "string"
+        elif depth == 0 and all(r == "command" for _, r in result) and (
+            i == 0 or _SUBCOMMAND.match(word)
+        ):
+            # docker run, git commit, ...
+            role = "command"
+        elif _ASSIGNMENT.match(word):
+            role = "assignment"
+        else:
+            role = "argument"
+        result.append((word, role))
+    return result
+
+
+def role_of(fragment: str, depth: int) -> str:
+    """What a fragment is, going by its first word"""
+    words = roles(fragment, depth)
+    return words[0][1] if words else "argument"
+
+
+def _paint_fragment(fragment: str, depth: int) -> str:
+    parts = []
+    pos = 0
+    for word, role in roles(fragment, depth):
+        start = fragment.index(word, pos)
+        parts.append(fragment[pos:start])
+        parts.append(paint(word, role, True))
+        pos = start + len(word)
+    parts.append(fragment[pos:])
+    return "".join(parts)
+
+
+class Highlighter:
+    """
+    Color an explanation as it streams. A line is held back until its
+    fragment is complete (at the separator), then the painted fragment goes
+    out and the description follows chunk by chunk; other lines, like the
+    summary, go out when they end. Escapes from the model are dropped either
+    way, so only color decides whether there are any.
+    """
+
+    def __init__(self, color: bool):
+        self.color = color
+        self.raw = ""
+        self.pending = ""
+        self.describing = False
+
+    def _strip(self, chunk: str, final: bool) -> str:
+        self.raw += chunk
+        cut = len(self.raw)
+        partial = None if final else _PARTIAL_ANSI.search(self.raw)
+        if partial:
+            cut = partial.start()
+        text, self.raw = self.raw[:cut], self.raw[cut:]
+        return _ANSI.sub("", text)
+
+    def feed(self, chunk: str) -> str:
+        self.pending += self._strip(chunk, False)
+        out = []
+        while self.pending:
+            newline = self.pending.find("\n")
+            if self.describing:
+                if newline < 0:
+                    out.append(self.pending)
+                    self.pending = ""
+                    break
+                out.append(self.pending[: newline + 1])
+                self.pending = self.pending[newline + 1 :]
+                self.describing = False
+                continue
+            line = self.pending if newline < 0 else self.pending[:newline]
+            parsed = parse_line(line)
+            if parsed is not None:
+                depth, fragment, _ = parsed
+                indent = line[: len(line) - len(line.lstrip())]
+                if self.color:
+                    fragment = _paint_fragment(fragment, depth)
+                out.append(f"{indent}{fragment}{SEPARATOR}")
+                self.pending = self.pending[_LINE.match(line).end() :]
+                self.describing = True
+            elif newline >= 0:
+                out.append(self.pending[: newline + 1])
+                self.pending = self.pending[newline + 1 :]
+            else:
+                break
+        return "".join(out)
+
+    def close(self) -> str:
+        """Whatever was held back, once the stream has ended"""
+        text = self.feed(self._strip("", True)) + self.pending
+        self.pending = ""
+        return text
+
+
+def colorize(text: str, color: bool) -> str:
+    """A whole explanation at once"""
+    highlighter = Highlighter(color)
+    return highlighter.feed(text) + highlighter.close()
+
+
+class Records:
+    """
+    An explanation as objects for machine consumers, each as soon as its line
+    is complete: {"type": "fragment", "text", "role", "explanation", "depth"}
+    per fragment, and {"type": "summary", "text"} for the closing line. Other
+    text comes as {"type": "text"}; a plain line is held until the next one
+    starts, since only the last is the summary.
+    """
+
+    def __init__(self):
+        self.plain = Highlighter(False)
+        self.buffer = ""
+        self.held: Optional[str] = None
+
+    def _line(self, line: str) -> List[dict]:
+        records = []
+        parsed = parse_line(line)
+        if parsed is None:
+            if line.strip():
+                if self.held is not None:
+                    records.append({"type": "text", "text": self.held})
+                self.held = line.strip()
+            return records
+        if self.held is not None:
+            records.append({"type": "text", "text": self.held})
+            self.held = None
+        depth, fragment, description = parsed
+        records.append(
+            {
+                "type": "fragment",
+                "text": fragment.strip(),
+                "role": role_of(fragment, depth),
+                "explanation": description.strip(),
+                "depth": depth,
+            }
+        )
+        return records
+
+    def feed(self, chunk: str) -> List[dict]:
+        self.buffer += self.plain.feed(chunk)
+        *lines, self.buffer = self.buffer.split("\n")
+        return [record for line in lines for record in self._line(line)]
+
+    def close(self) -> List[dict]:
+        lines = (self.buffer + self.plain.close()).split("\n")
+        self.buffer = ""
+        records = [record for line in lines for record in self._line(line)]
+        if self.held is not None:
+            records.append({"type": "summary", "text": self.held})
+            self.held = None
+        return records
@@ -0,0 +1,177 @@
+"""
+On-disk index of the options documented in installed man pages.
+
+`qq index build` parses every command page on MANPATH (see qq.manpages) into a
+sqlite database next to the cache; later builds only re-parse pages whose mtime
+changed. Once built, flag lookups for --quick/--offline come from the index,
+and explain() grounds the model with just the docs for the flags being asked
+about instead of the full few-shot prompt.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from typing import Optional
+
+from qq import manpages
+from qq.cache import cache_dir
+from qq.manpages import Option, Page
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    command TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS options (
+    command TEXT NOT NULL,
+    flag TEXT NOT NULL,
+    takes_arg INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    PRIMARY KEY (command, flag)
+) WITHOUT ROWID;
+"""
+
+
+def index_path() -> str:
+    return os.path.join(cache_dir(), "index.sqlite")
+
+
+class Index:
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            os.makedirs(cache_dir(), exist_ok=True)
+            path = index_path()
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.db.executescript(_SCHEMA)
+
+    def build(self, verbose: bool = False) -> dict:
+        """Bring the index up to date with MANPATH, re-parsing only changed pages"""
+        known = {
+            command: (path, mtime)
+            for command, path, mtime in self.db.execute(
+                "SELECT command, path, mtime FROM pages"
+            )
+        }
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        seen = set()
+
+        self.db.execute("BEGIN")
+        try:
+            for command, path in manpages.installed():
+                seen.add(command)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if known.get(command) == (path, mtime):
+                    counts["unchanged"] += 1
+                    continue
+
+                counts["updated" if command in known else "added"] += 1
+                if verbose:
+                    print(f"{command} ({path})", file=sys.stderr)
+                # pages with nothing usable are still recorded, so they aren't
+                # parsed again next time
+                page = manpages.load(path, command) or Page(command, "")
+                self._store(command, path, mtime, page)
+
+            for command in known.keys() - seen:
+                self._delete(command)
+                counts["removed"] += 1
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return counts
+
+    def _delete(self, command: str) -> None:
+        self.db.execute("DELETE FROM pages WHERE command = ?", (command,))
+        self.db.execute("DELETE FROM options WHERE command = ?", (command,))
+
+    def _store(self, command: str, path: str, mtime: float, page: Page) -> None:
+        self._delete(command)
+        self.db.execute(
+            "INSERT INTO pages (command, path, mtime, summary) VALUES (?, ?, ?, ?)",
+            (command, path, mtime, page.summary),
+        )
+        self.db.executemany(
+            "INSERT INTO options (command, flag, takes_arg, description) VALUES (?, ?, ?, ?)",
+            [
+                (command, o.flag, int(o.takes_arg), o.description)
+                for o in page.options.values()
+            ],
+        )
+
+    def page(self, command: str) -> Optional[Page]:
+        row = self.db.execute(
+            "SELECT summary FROM pages WHERE command = ?", (command,)
+        ).fetchone()
+        if row is None:
+            return None
+        page = Page(command, row[0])
+        for flag, takes_arg, description in self.db.execute(
+            "SELECT flag, takes_arg, description FROM options WHERE command = ?",
+            (command,),
+        ):
+            page.options[flag] = Option(flag, bool(takes_arg), description)
+        return page if page.summary or page.options else None
+
+    def stats(self) -> dict:
+        pages = self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        options = self.db.execute("SELECT COUNT(*) FROM options").fetchone()[0]
+        return {
+            "path": self.path,
+            "pages": pages,
+            "options": options,
+            "bytes": os.path.getsize(self.path),
+        }
+
+
+def available() -> bool:
+    return os.path.exists(index_path())
+
+
+def open_index() -> Optional[Index]:
+    """The index if `qq index build` has been run, else None"""
+    if not available():
+        return None
+    try:
+        return Index(index_path())
+    except sqlite3.Error:
+        return None
+
+
+def main(argv) -> None:
+    """qq index build|stats"""
+    parser = argparse.ArgumentParser(
+        prog="qq index", description="Index installed man pages for flag lookups"
+    )
+    parser.add_argument("action", choices=["build", "stats"])
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="List pages as they're parsed"
+    )
+    args = parser.parse_args(argv)
+
+    match args.action:
+        case "build":
+            start = time.monotonic()
+            counts = Index().build(verbose=args.verbose)
+            print(
+                f"indexed {counts['added']} new, {counts['updated']} changed,"
+                f" {counts['removed']} removed, {counts['unchanged']} unchanged pages"
+                f" in {time.monotonic() - start:.1f}s"
+            )
+        case "stats":
+            db = open_index()
+            if db is None:
+                sys.exit("no index yet, run `qq index build`")
+            stats = db.stats()
+            print(f"path:    {stats['path']}")
+            print(f"pages:   {stats['pages']}")
+            print(f"options: {stats['options']}")
+            print(f"size:    {stats['bytes'] / 1024:.1f} KiB")
@@ -0,0 +1,149 @@
+"""
+Local model backends: llama.cpp's server, Ollama, LM Studio, vLLM, or anything
+else serving the OpenAI API on this machine.
+
+discover() finds a running server (probing the usual ports unless a URL is
+given), health-checks it through /v1/models and picks a model. Requests then go
+through litellm's openai/ provider pointed at that server, so the rest of qq
+doesn't know the difference. Nothing here imports litellm.
+"""
+
+import argparse
+import json
+import os
+import sys
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+# where each server listens out of the box, in order of preference
+KNOWN_SERVERS = [
+    ("ollama", "http://127.0.0.1:11434/v1"),
+    ("llama.cpp", "http://127.0.0.1:8080/v1"),
+    ("lm studio", "http://127.0.0.1:1234/v1"),
+    ("vllm", "http://127.0.0.1:8000/v1"),
+]
+
+# connection refused comes back immediately; this only bounds firewalled ports
+PROBE_TIMEOUT = 0.5
+# the first request after a server starts may have to load weights from disk
+WARM_TIMEOUT = 120
+
+
+class NotFound(ConnectionError):
+    pass
+
+
+@dataclass
+class Server:
+    name: str
+    url: str
+    models: List[str]
+
+    def engine(self, model: Optional[str] = None) -> Dict:
+        """Engine arguments for model (default: the first one served)"""
+        return {
+            "model": f"openai/{model or self.models[0]}",
+            "api_base": self.url,
+            # litellm insists on a key; local servers ignore it
+            "api_key": os.environ.get("QQ_LOCAL_API_KEY", "local"),
+        }
+
+
+def _base_url(url: str) -> str:
+    url = url.rstrip("/")
+    if "://" not in url:
+        url = f"http://{url}"
+    return url if url.endswith("/v1") else f"{url}/v1"
+
+
+def _call(url: str, body: Optional[Dict] = None, timeout: float = PROBE_TIMEOUT):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(
+        url, data=data, headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return json.load(response)
+
+
+def check(name: str, url: str) -> Optional[Server]:
+    """The server at url if it's up and serving at least one model"""
+    try:
+        listing = _call(f"{url}/models")
+        models = [m["id"] for m in listing.get("data", [])]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+    return Server(name, url, models) if models else None
+
+
+def probe(url: Optional[str] = None) -> List[Server]:
+    """Every healthy server among url (if given) or the well-known ports"""
+    candidates = [("local", _base_url(url))] if url else KNOWN_SERVERS
+    with ThreadPoolExecutor(len(candidates)) as pool:
+        found = pool.map(lambda c: check(*c), candidates)
+        return [server for server in found if server is not None]
+
+
+def discover(url: Optional[str] = None) -> Server:
+    servers = probe(url)
+    if not servers:
+        tried = _base_url(url) if url else ", ".join(u for _, u in KNOWN_SERVERS)
+        raise NotFound(f"no local model server found (tried {tried})")
+    return servers[0]
+
+
+def warm(server: Server, model: Optional[str] = None, messages: List[Dict] = None) -> bool:
+    """
+    Make the server load model now rather than on the first real request.
+    Warming with the system prompt qq is about to use also lets llama.cpp and
+    Ollama reuse its KV cache for the prefix.
+    """
+    body = {
+        "model": model or server.models[0],
+        "messages": messages or [{"role": "user", "content": "hi"}],
+        "max_tokens": 1,
+        "stream": False,
+    }
+    try:
+        _call(f"{server.url}/chat/completions", body, timeout=WARM_TIMEOUT)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def main(argv) -> None:
+    """qq local status|warm"""
+    parser = argparse.ArgumentParser(
+        prog="qq local", description="Find and warm up local model servers"
+    )
+    parser.add_argument("action", choices=["status", "warm"])
+    parser.add_argument(
+        "--local-url",
+        default=os.environ.get("QQ_LOCAL_URL"),
+        help="Server to use instead of probing the usual ports",
+    )
+    parser.add_argument(
+        "--local-model",
+        default=os.environ.get("QQ_LOCAL_MODEL"),
+        help="Model to warm up (default: the first one the server lists)",
+    )
+    args = parser.parse_args(argv)
+
+    match args.action:
+        case "status":
+            servers = probe(args.local_url)
+            if not servers:
+                print("no local model server found")
+                sys.exit(1)
+            for server in servers:
+                print(f"{server.name} {server.url} - {', '.join(server.models)}")
+        case "warm":
+            try:
+                server = discover(args.local_url)
+            except NotFound as e:
+                sys.exit(str(e))
+            model = args.local_model or server.models[0]
+            if not warm(server, model):
+                sys.exit(f"{server.name} failed to load {model}")
+            print(f"{server.name} {model} ready")
@@ -0,0 +1,30 @@
+"""
+litellm callback feeding usage and cost into qq's per-request metrics. Only
+imported once litellm itself has been loaded.
+"""
+
+from litellm.integrations.custom_logger import CustomLogger
+
+from qq import metrics
+
+
+class MetricsLogger(CustomLogger):
+    """Match litellm success events to RequestMetrics by litellm_call_id"""
+
+    def _record(self, kwargs, response_obj):
+        record = metrics.lookup(kwargs.get("litellm_call_id"))
+        if record is None:
+            return
+        usage = getattr(response_obj, "usage", None)
+        record.report(
+            cost=kwargs.get("response_cost") or 0,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0),
+            completion_tokens=getattr(usage, "completion_tokens", 0),
+            cached_tokens=metrics.cached_tokens(usage),
+        )
+
+    def log_success_event(self, kwargs, response_obj, start_time, end_time):
+        self._record(kwargs, response_obj)
+
+    async def async_log_success_event(self, kwargs, response_obj, start_time, end_time):
+        self._record(kwargs, response_obj)
@@ -1,200 +1,95 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import functools
+import importlib
+import json
 import os
 import sys
 import platform
 import subprocess
 import sys
 import tempfile
-from functools import partial
-from typing import Callable, Dict
+import threading
+from contextlib import aclosing
+from typing import Dict, List, Optional
 import readline
 import cmd
 
-import litellm
-from litellm import completion_cost
-from litellm.integrations.custom_logger import CustomLogger
-
-# this sucks
-_response_cost = 0.0
-
-
-def _track_cost(kwargs, *args):
-    global _response_cost
-    _response_cost += float(kwargs.get("response_cost", 0))
-    print(f"\033[1;37mCost ${_response_cost:.4f}\033[0m ", file=sys.stderr)
-
-
-# this is so bad
-litellm.success_callback = [_track_cost]
-
-EXPLAIN_PROMPT = """
-You are an expert in explaining command-line operations across various operating systems and shells. Your task is to provide clear, concise, and accurate explanations of commands, pipelines, and scripts. Follow these guidelines:
-
-<guidelines>
-1. Break down the command into its constituent parts.
-2. Format your output with the main command fragment at the beginning of the line and subsequent parts indented based on their role.
-3. Print out the formatted command part and then an explanation of that command fragment separated by a hyphen, on the same line.
-4. If colors are enabled, use subtle color codes to enhance readability. Apply different colors to commands, options, arguments, and other syntactic structures as appropriate. Be consistent but maintain clarity. Make sure the coloring is added correctly for being streamed to the output terminal.
-5. For each part, describe its function, any options or flags used, and their effects.
-6. If applicable, mention any potential side effects or important considerations.
-7. Conclude with a one-line summary of the overall operation.
-8. Use technical terminology where appropriate
-9. Make sure your output is formatted correctly and carefully to be clear and visually appealing. Don't use excessive spacing or newlines, keep your output condensed, but add a newline before the final command explanation.
-10. If the shell supports colors, intelligently colorize your output, but if the shell does not, do not output any colors. 
-    It is very important that if colors are disabled, you do not output colors, despite what the examples say.
-11. Do not include <output></output> tags or special formatting tags like backticks. These are unnecessary on the terminal.
-</guidelines>
-
-<system_information>
-Shell color support: :r:color_support
-</system_information>
-
-<examples>
-<input>
-find . -type f -name "*.txt" -exec sed -i 's/foo/bar/g' {} +
-</input>
-<output>
-\033[1;34mfind\033[0m \033[1;32m.\033[0m - Start searching from the current directory
-    \033[1;35m-type\033[0m \033[1;32mf\033[0m - Look for regular files only
-    \033[1;35m-name\033[0m \033[1;33m"*.txt"\033[0m - Match files with names ending in .txt
-    \033[1;35m-exec\033[0m \033[1;36msed\033[0m - Execute the following command for each matched file
-        \033[1;35m-i\033[0m - Edit files in-place
-        \033[1;33m's/foo/bar/g'\033[0m - Replace all occurrences of 'foo' with 'bar'
-    \033[1;32m{} +\033[0m - Pass multiple filenames to sed efficiently
-This command finds all .txt files in the current directory and its subdirectories, then replaces all occurrences of 'foo' with 'bar' in each file.
-</output>
-<input>
-docker run --rm -d --name nginx -p 80:80 -v /host/path:/container/path nginx:latest
-</input>
-<output>
-\033[1;34mdocker run\033[0m - Run a Docker container
-    \033[1;35m--rm\033[0m - Automatically remove the container when it exits
-    \033[1;35m-d\033[0m - Run the container in detached mode (in the background)
-    \033[1;35m--name\033[0m \033[1;33mnginx\033[0m - Assign the name "nginx" to the container
-    \033[1;35m-p\033[0m \033[1;33m80:80\033[0m - Map port 80 of the host to port 80 in the container
-    \033[1;35m-v\033[0m \033[1;33m/host/path:/container/path\033[0m - Mount a volume, mapping /host/path on the host to /container/path in the container
-    \033[1;36mnginx:latest\033[0m - Use the latest version of the nginx image
-This command starts a detached nginx container named "nginx", mapping port 80 and a volume, using the latest nginx image.
-</output>
-<input>
-grep -r '/opt/home' ~/.*(D.)
-</input>
-<output>
-\033[1;34mgrep\033[0m - Search for patterns in files
-    \033[1;35m-r\033[0m - Recursively search subdirectories
-    \033[1;33m'/opt/home'\033[0m - The pattern to search for
-    \033[1;36m~/.*(D.)\033[0m - Zsh glob pattern that matches all hidden files and directories in the home directory
-This command searches for the string '/opt/home' in all hidden files and directories (dotfiles) in the user's home directory using Zsh-specific globbing.
-
-Input: curl -s 'https://api.github.com/repos/stedolan/jq/commits?per_page=5' | jq -r '.[] | "\\(.commit.author.date) \\(.commit.author.name)"'
-Output:
-\033[1;34mcurl\033[0m - Command-line tool for transferring data using various protocols
-    \033[1;35m-s\033[0m - Silent mode, don't show progress meter or error messages
-    \033[1;33m'https://api.github.com/repos/stedolan/jq/commits?per_page=5'\033[0m - URL of the GitHub API endpoint for jq repository commits, limited to 5 per page
-\033[1;36m|\033[0m - Pipe the output of curl to the next command
-\033[1;34mjq\033[0m - Command-line JSON processor
-    \033[1;35m-r\033[0m - Output raw strings, not JSON texts
-    \033[1;33m'.[] | "\\(.commit.author.date) \\(.commit.author.name)"'\033[0m - JQ filter:
-        \033[1;33m.[]\033[0m - Iterate over each item in the array
-        \033[1;33m| "\\(.commit.author.date) \\(.commit.author.name)"\033[0m - For each commit, print the author's date and name
-This command fetches the last 5 commits from the jq GitHub repository and extracts the date and author name for each commit.
-</output>
-<input>
-http -a username:password POST https://api.example.com/v1/users name=John age:=30 roles:='["admin", "user"]'
-</input>
-<output>
-\033[1;34mhttp\033[0m - Command-line HTTP client (part of HTTPie)
-    \033[1;35m-a\033[0m \033[1;33musername:password\033[0m - Specify basic authentication credentials
-    \033[1;35mPOST\033[0m - Use HTTP POST method
-    \033[1;33mhttps://api.example.com/v1/users\033[0m - URL of the API endpoint
-    \033[1;36mname=John\033[0m - Set 'name' field to 'John' (sent as form data)
-    \033[1;36mage:=30\033[0m - Set 'age' field to integer 30 (`:=` for non-string data types)
-    \033[1;36mroles:='["admin", "user"]'\033[0m - Set 'roles' field to a JSON array (`:=` for JSON data)
-This command sends a POST request to create a new user with the given name, age, and roles, using basic authentication.
-</output>
-</examples>
-"""
-
-GENERATE_PROMPT = """
-You are an expert in generating command-line operations across various operating systems and shells. Your task is to create efficient, effective, and safe commands based on user descriptions. 
-
-Current system information:
-- Operating System: :r:os (Version: :r:os_version)
-- Shell: :r:shell
-- Python Version: :r:python_version
-- User: :r:user
-- Home Directory: :r:home
-
-Shell color support: :r:color_support. If the shell supports colors, intelligently colorize your output, but if the shell does not, do not output colors.
-
-Follow these guidelines:
-
-1. Output only the command or script, wrapped in <command></command> tags.
-2. Ensure the command is correct, efficient, and follows best practices for the current operating system and shell.
-3. Use appropriate flags, options, and syntax for the current environment.
-4. Incorporate error handling and safety checks where appropriate.
-5. For complex operations, consider using multiple commands connected with pipes or creating a small script.
-6. When working with dotfiles or hidden files in Zsh, use the glob pattern ~/.*(D.) to match all hidden files and directories in the home directory.
-7. Tailor your commands to the specific OS and shell environment provided above.
-
-Examples:
-
-Input: Find all Python files modified in the last 7 days and create a zip archive of them
-Output: <command>find . -type f -name "*.py" -mtime -7 -print0 | xargs -0 zip updated_python_files.zip</command>
-
-Input: Monitor system resource usage, logging CPU, memory, and disk usage every 5 seconds to a file named system_usage.log
-Output: <command>while true; do echo "$(date): $(top -bn1 | grep load | awk '{printf "CPU Load: %.2f", $(NF-2)}') $(free -m | awk 'NR==2{printf " Memory Usage: %s/%sMB %.2f%%", $3,$2,$3*100/$2 }') $(df -h | awk '$NF=="/"{printf " Disk Usage: %d/%dGB %s", $3,$2,$5}')"; sleep 5; done >> system_usage.log</command>
-
-Input: Create a bash script that backs up all .jpg files in the current directory to a timestamped folder in /backups, compresses the folder, and deletes files older than 30 days
-Output: <command>cat << 'EOF' > backup_script.sh
-#!/bin/bash
-set -e
-
-BACKUP_DIR="/backups/photos_$(date +%Y%m%d_%H%M%S)"
-mkdir -p "$BACKUP_DIR"
-
-find . -maxdepth 1 -type f -name "*.jpg" -exec cp {} "$BACKUP_DIR" \\;
-
-tar czf "${BACKUP_DIR}.tar.gz" "$BACKUP_DIR"
-rm -rf "$BACKUP_DIR"
-
-find /backups -type f -name "photos_*.tar.gz" -mtime +30 -delete
-
-echo "Backup completed successfully"
-EOF
-chmod +x backup_script.sh</command>
-
-Input: Set up a cron job to run a Python script every day at 3 AM
-Output: <command>(crontab -l 2>/dev/null; echo "0 3 * * * /usr/bin/python3 /path/to/your/script.py") | crontab -</command>
-
-Input: Create a Docker command to run a PostgreSQL container with a custom configuration, set a password, and map to a local volume
-Output: <command>docker run -d --name postgres_db -e POSTGRES_PASSWORD=mysecretpassword -v /path/to/local/data:/var/lib/postgresql/data -v /path/to/custom/postgresql.conf:/etc/postgresql/postgresql.conf postgres:latest -c 'config_file=/etc/postgresql/postgresql.conf'</command>
-
-Input: Search for all instances of '/opt/home' in my dotfiles using Zsh
-Output: <command>grep -r '/opt/home' ~/.*(D.)</command>
-"""
+from qq import cache
+from qq.context import DEFAULT_MAX_TOKENS, Conversation
+from qq.prompts import (
+    EXPLAIN_PROMPT,
+    GENERATE_PROMPT,
+    GROUNDED_EXPLAIN_PROMPT,
+    SUMMARY_PROMPT,
+)
+from qq import race
+from qq.engine import Engine, Prefetch
+from qq.highlight import Highlighter, Records, colorize
+from qq.race import RaceEngine
+from qq.render import Renderer
+from qq.resilience import Policy, ResilientEngine
+from qq.metrics import Session
+from qq.stream import CommandParser
+
+DEFAULT_MODEL = "gpt-4o-mini"  # "claude-3-sonnet-20240229"
+
+# max_tokens per mode; generate only needs the command itself, and stops at
+# </command> both on the provider's side and ours
+TOKEN_BUDGETS = {"explain": 1024, "generate": 512}
+# the one-line summary closing a --fragments explanation
+SUMMARY_TOKENS = 100
+# how long a --revalidate request may hold up quitting or running the command
+REVALIDATE_TIMEOUT = 10
 
 
 class gencmd(cmd.Cmd):
     prompt = "(e)xplain / e(x)ec / ed(i)t / (r)eprompt / (q)uit > "
     use_rawinput = False
 
-    def __init__(self, command, query, llm, args):
+    def __init__(
+        self,
+        command,
+        query,
+        llm,
+        args,
+        loop,
+        prefetch=None,
+        echoed=False,
+        on_exec=None,
+    ):
         super().__init__()
         self.command = command
         self.query = query
         self.llm = llm
         self.args = args
+        # the menu runs on its own thread; requests go back to the event loop
+        self.loop = loop
+        # explanation of self.command already streaming in the background
+        self.prefetch = prefetch
+        self.prefetch_command = command
+        # generate() already streamed "Command to execute: ..." as it arrived
+        self.echoed = echoed
+        # coroutine function run on the loop with the command before it's exec'd
+        self.on_exec = on_exec
 
     def do_e(self, arg):
         """Explain the command"""
-        explain(self.llm, self.command, self.args)
+        source = self.prefetch.replay() if self.prefetch else None
+        asyncio.run_coroutine_threadsafe(
+            explain(self.llm, self.command, self.args, source), self.loop
+        ).result()
 
     def do_x(self, arg):
         """execlp() the command"""
+        if self.on_exec:
+            asyncio.run_coroutine_threadsafe(
+                self.on_exec(self.command), self.loop
+            ).result()
         # bye! this might not be safe if we have any fds open but w/e
+        emit_metrics(self.llm, self.args)
         os.execlp("zsh", "zsh", "-c", self.command)
 
     def do_i(self, arg):
@@ -210,6 +105,10 @@ class gencmd(cmd.Cmd):
         finally:
             os.unlink(tmp_filename)
 
+        if self.prefetch and self.command != self.prefetch_command:
+            self.loop.call_soon_threadsafe(self.prefetch.cancel)
+            self.prefetch = None
+
     def do_r(self, arg):
         """Issue follow up query for prompt"""
         self.query = input("> ")
@@ -224,7 +123,8 @@ class gencmd(cmd.Cmd):
         self.do_help(None)
 
     def preloop(self):
-        print(f"Command to execute: {self.command}")
+        if not self.echoed:
+            print(f"Command to execute: {self.command}")
 
     def postcmd(self, stop, line):
         print(f"Command to execute: {self.command}")
@@ -234,7 +134,8 @@ class gencmd(cmd.Cmd):
 def supports_color(enabled: bool):
     """
     Returns True if the running system's terminal supports color,
-    and False otherwise.
+    and False otherwise. It alone decides whether output is colored: models
+    are asked for plain text, which qq.highlight colors.
     """
     if enabled:
         plat = sys.platform
@@ -246,32 +147,401 @@ def supports_color(enabled: bool):
     return False
 
 
-def imbue(prompt: str, info: Dict[str, str]) -> str:
-    for key, value in info.items():
-        prompt = prompt.replace(f":r:{key}", str(value), 1)
-    return prompt
-
+def startup_profile(limit: int = 15) -> None:
+    """
+    Report where startup time goes, a la `python -X importtime`. The CLI path
+    (import qq.main) and the provider stack (litellm) are measured separately
+    in fresh interpreters so that regressions in either show up.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    phases = [
+        ("cli", "import qq.main"),
+        ("provider", "import qq.main, qq.engine; qq.engine._load_litellm()"),
+    ]
+    for name, code in phases:
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            cwd=root,
+        )
+        if proc.returncode != 0:
+            print(f"\033[1;31m{name}\033[0m ({code}) - failed")
+            print(proc.stderr.strip().splitlines()[-1], file=sys.stderr)
+            continue
+
+        # lines look like "import time:  self [us] | cumulative | imported package",
+        # with nested imports indented two extra spaces per level
+        rows = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "[us]" in line:
+                continue
+            self_us, cumulative_us, module = line[len("import time:") :].split("|")
+            depth = (len(module) - len(module.lstrip()) - 1) // 2
+            rows.append((int(self_us), int(cumulative_us), depth, module.strip()))
+
+        total = sum(r[0] for r in rows)
+        print(f"\033[1;34m{name}\033[0m ({code}) - {total / 1000:.1f} ms total")
+        top = sorted((r for r in rows if r[2] <= 1), key=lambda r: -r[1])
+        for self_us, cumulative_us, _, module in top[:limit]:
+            print(
+                f"    {cumulative_us / 1000:8.1f} ms  {self_us / 1000:8.1f} ms self  {module}"
+            )
+
+
+def _budget(mode: str, args: dict) -> int:
+    return args.max_tokens or TOKEN_BUDGETS[mode]
+
+
+def _reference(query: str) -> str:
+    """
+    Man page docs for the commands and flags in query, from `qq index`, or ""
+    if there's no index or it knows nothing about them
+    """
+    from qq import index, offline
 
-def explain(llm: Callable, query: str, args: dict) -> None:
-    system_prompt = imbue(
-        EXPLAIN_PROMPT,
-        {"color_support": "enabled" if supports_color(args.color) else "disabled"},
+    if not index.available():
+        return ""
+    try:
+        stages = offline.explain(query)
+    except ValueError:
+        # not valid shell (an open quote), so there's nothing to look up
+        return ""
+    lines = []
+    for stage in stages:
+        if stage.command:
+            lines.append(" - ".join(stage.command))
+        for fragment in stage.fragments:
+            if fragment.role == "option" and fragment.description:
+                lines.append(f"    {fragment.text} - {fragment.description}")
+    return "\n".join(lines)
+
+
+def _explain_request(query: str, args: dict, model: str):
+    """Cache key and messages for explaining query with model"""
+    variables = {}
+
+    # ground the model in the relevant man page docs when the index has them,
+    # which also lets it get by with a much shorter prompt
+    prompt = EXPLAIN_PROMPT
+    reference = _reference(query)
+    if reference:
+        prompt = GROUNDED_EXPLAIN_PROMPT
+        variables["reference"] = reference
+
+    key = cache.make_key(
+        "explain",
+        cache.normalize(query),
+        model,
+        args.temperature,
+        _budget("explain", args),
+        prompt.hash,
+        *([reference] if reference else []),
     )
+    messages = [
+        prompt.system_message(variables, model),
+        {"role": "user", "content": query},
+    ]
+    return key, messages
+
+
+async def _explanation(llm: Engine, query: str, args: dict):
+    """Stream the explanation of query, from the cache when possible"""
+    key, messages = _explain_request(query, args, llm.model)
+    async with aclosing(
+        _cached(llm, key, messages, args, _budget("explain", args))
+    ) as stream:
+        async for content in stream:
+            yield content
+
 
+async def _cached(
+    llm: Engine, key: str, messages: List[Dict], args: dict, max_tokens: int
+):
+    """
+    Stream a response to messages, replaying it from the cache when possible
+    and storing it once it's been received in full
+    """
+    # a hit replays the stored text without touching litellm at all
+    store = None if args.no_cache else cache.open_cache()
+    if store and not args.refresh:
+        hit = store.get(key)
+        if hit is not None:
+            llm.session.cache_hit(llm.model)
+            yield hit
+            return
+
+    result = ""
+    async with aclosing(llm.stream(messages, max_tokens=max_tokens)) as stream:
+        async for content in stream:
+            result += content
+            yield content
+
+    if store and result:
+        store.put(key, result)
+
+
+async def _stage_explanation(llm: Engine, text: str, args: dict, depth: int):
+    """
+    The model's explanation of one stage of a pipeline, indented to depth and
+    without its closing summary line (the whole command gets one of its own)
+    """
+    indent = "    " * depth
+    buffer = ""
+    held = None
+    sent = 0
+    async with aclosing(_explanation(llm, text, args)) as stream:
+        async for content in stream:
+            buffer += content
+            *lines, buffer = buffer.split("\n")
+            for line in filter(str.strip, lines):
+                # hold each line back until we know it isn't the last
+                if held is not None:
+                    yield f"{indent}{held}\n"
+                    sent += 1
+                held = line
+    # drop the summary, unless it's all there is
+    if held is not None and (buffer.strip() or not sent):
+        yield f"{indent}{held}\n"
+
+
+async def _quick_explanation(llm: Engine, query: str, args: dict):
+    """
+    Explain query from installed man pages, asking the model (concurrently)
+    only about the stages that couldn't be resolved, unless --offline
+    """
+    from qq import offline
+
+    try:
+        stages = offline.explain(query)
+    except ValueError as e:
+        # an open quote and the like: no words to look up, so it's the model's
+        if args.offline:
+            yield f"Can't explain this without the model: {e}\n"
+            return
+        async with aclosing(_explanation(llm, query, args)) as stream:
+            async for content in stream:
+                yield content
+        return
+    fetches = [
+        Prefetch(_stage_explanation(llm, stage.text, args, stage.depth))
+        if not stage.resolved and not args.offline
+        else None
+        for stage in stages
+    ]
+    try:
+        for stage, fetch in zip(stages, fetches):
+            if fetch is None:
+                yield offline.render(stage)
+                continue
+            async with aclosing(fetch.replay()) as lines:
+                async for line in lines:
+                    yield line
+        yield offline.summary(stages)
+    finally:
+        for fetch in fetches:
+            if fetch:
+                fetch.cancel()
+
+
+def _summary(llm: Engine, query: str, args: dict):
+    """Stream a one-sentence summary of query, from the cache when possible"""
+    key = cache.make_key(
+        "summary", cache.normalize(query), llm.model, args.temperature, SUMMARY_PROMPT.hash
+    )
     messages = [
-        {"role": "system", "content": system_prompt},
+        SUMMARY_PROMPT.system_message({}, llm.model),
         {"role": "user", "content": query},
     ]
+    return _cached(llm, key, messages, args, SUMMARY_TOKENS)
+
+
+async def _fragment_explanation(llm: Engine, query: str, args: dict):
+    """
+    Explain each top-level command of a pipeline or list on its own, so each
+    is cached separately and an edited pipeline only costs what changed, then
+    summarize the whole
+    """
+    from qq import offline
+
+    try:
+        parts = offline.split(query)
+    except ValueError:
+        # an open quote: no telling where the commands end, so keep it whole
+        parts = [query]
+    if len(parts) == 1:
+        async with aclosing(_explanation(llm, query, args)) as stream:
+            async for content in stream:
+                yield content
+        return
+
+    fetches = [
+        None
+        if part in offline.OPERATORS
+        else Prefetch(_stage_explanation(llm, part, args, 0))
+        for part in parts
+    ]
+    summary = Prefetch(_summary(llm, query, args))
+    try:
+        for part, fetch in zip(parts, fetches):
+            if fetch is None:
+                yield offline.render(offline.operator(part))
+                continue
+            async with aclosing(fetch.replay()) as lines:
+                async for line in lines:
+                    yield line
+        async with aclosing(summary.replay()) as stream:
+            async for content in stream:
+                yield content
+    finally:
+        summary.cancel()
+        for fetch in fetches:
+            if fetch:
+                fetch.cancel()
+
+
+def _explain_source(llm: Engine, query: str, args: dict):
+    if args.quick or args.offline:
+        return _quick_explanation(llm, query, args)
+    if args.fragments:
+        return _fragment_explanation(llm, query, args)
+    return _explanation(llm, query, args)
+
+
+def _dumps(records: List[dict], fmt: str, first: bool) -> str:
+    """records as ndjson lines, or as elements of a json array that's been opened"""
+    if fmt == "ndjson":
+        return "".join(json.dumps(record) + "\n" for record in records)
+    return "".join(
+        ("" if first and i == 0 else ",\n") + json.dumps(record)
+        for i, record in enumerate(records)
+    )
+
+
+async def _structured(source, fmt: str):
+    """An explanation stream as JSON objects, sent as each line completes"""
+    records = Records()
+    first = True
+    if fmt == "json":
+        yield "["
+    async with aclosing(source) as stream:
+        async for content in stream:
+            batch = records.feed(content)
+            if batch:
+                yield _dumps(batch, fmt, first)
+                first = False
+    yield _dumps(records.close(), fmt, first)
+    if fmt == "json":
+        yield "]"
+
+
+async def explain(llm: Engine, query: str, args: dict, source=None) -> None:
+    """Print the explanation of query, or of an already-running source stream"""
+    if source is None:
+        source = _explain_source(llm, query, args)
+    highlighter = None
+    if args.format == "text":
+        highlighter = Highlighter(supports_color(args.color))
+    else:
+        source = _structured(source, args.format)
+    with Renderer() as out:
+        async with aclosing(source) as stream:
+            async for content in stream:
+                out.write(highlighter.feed(content) if highlighter else content)
+        if highlighter:
+            out.write(highlighter.close())
+        if args.format != "ndjson":
+            out.write("\n")
+    print(llm.session.cost_line(), file=sys.stderr)
+
+
+async def explain_batch(llm: Engine, path: str, args: dict) -> None:
+    """Explain every command in a script or history file, in input order"""
+    from qq import batch
+
+    if path == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(path, "rb") as fp:
+            data = fp.read()
+    commands = batch.dedupe(batch.parse(batch.decode_history(data)))
+
+    store = None if args.no_cache else cache.open_cache()
+
+    def lookup(command):
+        if not store or args.refresh:
+            return None
+        hit = store.get(_explain_request(command, args, llm.model)[0])
+        if hit is not None:
+            llm.session.cache_hit(llm.model)
+        return hit
+
+    async def fetch(command):
+        _, messages = _explain_request(command, args, llm.model)
+        return await llm.text(messages, max_tokens=_budget("explain", args))
+
+    color = supports_color(args.color)
+    header = "\033[1;37m$ {}\033[0m" if color else "$ {}"
+    first = True
+    failed = 0
+    if args.format == "json":
+        print("[", end="")
+    results = batch.run(commands, lookup, fetch, jobs=args.jobs)
+    async for command, result, cached in results:
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"{command}: {result}", file=sys.stderr)
+            continue
+        if args.format == "text":
+            print(header.format(command))
+            print(colorize(result, color).rstrip("\n"))
+            print()
+        else:
+            records = Records()
+            objects = [
+                {"command": command, **record}
+                for record in records.feed(result) + records.close()
+            ]
+            if objects:
+                print(_dumps(objects, args.format, first), end="", flush=True)
+                first = False
+        if store and not cached and result:
+            store.put(_explain_request(command, args, llm.model)[0], result)
+    if args.format == "json":
+        print("]")
+    print(llm.session.cost_line(), file=sys.stderr)
+    if failed:
+        print(f"{failed} of {len(commands)} commands failed", file=sys.stderr)
+        sys.exit(1)
+
 
-    for chunk in llm(messages=messages):
-        content = chunk.choices[0].delta.content
-        if content:
-            print(content, end="", flush=True)
-    print()
+async def _in_thread(fn):
+    """
+    Run a blocking fn (the interactive menu) on a daemon thread so the event
+    loop keeps running, and ctrl-c doesn't have to wait for input() to return
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def target():
+        try:
+            result = fn()
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(resolve, future.set_result, result)
 
+    threading.Thread(target=target, daemon=True).start()
+    return await future
 
-def generate(llm: Callable, query: str, args: dict) -> None:
-    color_support = supports_color(args.color)
+
+@functools.cache
+def _system_info(env: bool) -> Dict[str, str]:
+    """Facts about this machine for the generate prompt; they don't change mid-run"""
     system_info = {
         "os": platform.system(),
         "os_version": platform.version(),
@@ -280,49 +550,285 @@ def generate(llm: Callable, query: str, args: dict) -> None:
         "user": os.environ.get("USER", "Unknown"),
         "home": os.environ.get("HOME", "Unknown"),
     }
-    if not args.env:
+    if not env:
         system_info = {k: "Unknown" for k in system_info.keys()}
+    return system_info
 
-    system_info["color_support"] = color_support
-    system_prompt = imbue(GENERATE_PROMPT, system_info)
-    if args.debug:
-        print("\033[1;34mgenerate system prompt\033[0m")
-        print(system_prompt)
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-    ]
+async def _command(llm: Engine, messages: List[Dict], args: dict, echo: bool = True):
+    """
+    Generate a command, echoing it as it streams in, and hang up as soon as
+    it's complete: anything the model says after </command> is wasted.
+    Returns the command and whether anything was echoed.
+    """
+    parser = CommandParser()
+    echoed = False
+    overrides = {"max_tokens": _budget("generate", args), "stop": [CommandParser.CLOSE]}
+    if isinstance(llm, RaceEngine):
+        # a model only wins once it has produced a whole <command> block
+        overrides["ready"] = race.command_ready
+    with Renderer() as out:
+        async with aclosing(llm.stream(messages, **overrides)) as stream:
+            async for content in stream:
+                text = parser.feed(content)
+                if text and echo:
+                    if not echoed:
+                        out.write("Command to execute: ")
+                        echoed = True
+                    out.write(text)
+                if parser.closed:
+                    break
+        if echoed:
+            out.write("\n")
+    return parser.result(), echoed
+
+
+def _semantic_cache(args: dict):
+    """
+    The semantic cache for generate and the scope for this machine, or
+    (None, None) unless an embedding model is configured
+    """
+    if args.no_cache or not args.embed_model:
+        return None, None
+    from qq import semantic
 
-    while True:
-        messages.append({"role": "user", "content": query})
+    try:
+        store = semantic.SemanticCache(
+            semantic.embedder(args.embed_model, args.local_url),
+            threshold=args.similarity or semantic.DEFAULT_THRESHOLD,
+        )
+    except Exception as e:
+        print(f"\033[1;33msemantic cache disabled: {e}\033[0m", file=sys.stderr)
+        return None, None
+
+    # commands for Linux/zsh shouldn't be served on macOS/bash, even when
+    # --env keeps the details out of the prompt
+    info = _system_info(True)
+    scope = cache.make_key(
+        info["os"],
+        os.path.basename(info["shell"]),
+        info["user"],
+        info["home"],
+        args.env,
+        GENERATE_PROMPT.hash,
+    )
+    return store, scope
 
-        result = ""
-        for chunk in llm(messages=messages):
-            content = chunk.choices[0].delta.content
-            if content:
-                result += content
 
-        messages.append({"role": "assistant", "content": result})
+async def _revalidate(llm, messages, args) -> Optional[str]:
+    """Regenerate a command served from the semantic cache, for next time"""
+    try:
+        command, _ = await _command(llm, messages, args, echo=False)
+    except Exception:
+        return None
+    return command or None
 
-        command_start = result.find("<command>") + len("<command>")
-        command_end = result.find("</command>")
-        command = result[command_start:command_end].strip()
-        # clean it up a little
-        result = result.replace("<command>", "").replace("</command>", "")
 
-        # print(f"Command to execute: {command}")
-        c = gencmd(command, query, llm, args)
-        c.cmdloop()
+async def generate(
+    llm: Engine, query: str, args: dict, explainer: Engine = None
+) -> None:
+    """
+    Generate a command with llm, then offer to explain it with explainer
+    (which may be a different backend, e.g. a local model)
+    """
+    explainer = explainer or llm
+    system_info = _system_info(args.env)
+    if args.debug:
+        print("\033[1;34mgenerate system prompt\033[0m")
+        print(GENERATE_PROMPT.render(system_info))
+
+    conversation = Conversation(
+        GENERATE_PROMPT.system_message(system_info, llm.model),
+        max_tokens=args.context_tokens,
+    )
+
+    # only the first description goes through the semantic cache; refinements
+    # only make sense together with what came before
+    semantic, scope = _semantic_cache(args)
+    first = True
+    revalidation = None
+    # (query, vector) to store the command under once it's run
+    unstored = None
+
+    async def settle(command: str = None) -> None:
+        """
+        Store the command being run, or the revalidated one if the run
+        command came from the cache; without a command, drop what's pending
+        """
+        if not command or not unstored:
+            if revalidation:
+                revalidation.cancel()
+            return
+        if revalidation:
+            try:
+                command = await asyncio.wait_for(revalidation, REVALIDATE_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+            if not command:
+                return
+        asked, vector = unstored
+        semantic.put(scope, asked, command, vector)
+
+    while True:
+        conversation.ask(query)
+        messages = conversation.messages()
+        if args.debug:
+            print(f"\033[1;34m{conversation.savings()}\033[0m")
+
+        hit = None
+        if semantic and first:
+            try:
+                vector = await asyncio.to_thread(semantic.embed, query)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"\033[1;33msemantic cache disabled: {e}\033[0m", file=sys.stderr)
+                semantic = None
+            else:
+                hit = None if args.refresh else semantic.lookup(scope, query, vector)
+
+        if hit:
+            command, echoed = hit.command, False
+            llm.session.cache_hit(llm.model)
+            print(
+                f"\033[1;37mSimilar to: {hit.query} ({hit.similarity:.2f})\033[0m",
+                file=sys.stderr,
+            )
+            if args.revalidate:
+                # held onto so the task isn't garbage collected mid-request
+                revalidation = asyncio.create_task(_revalidate(llm, messages, args))
+            unstored = (query, vector)
+        else:
+            command, echoed = await _command(llm, messages, args)
+            if semantic and first:
+                # only stored if it's run: a command sent back with r was wrong
+                unstored = (query, vector)
+        print(llm.session.cost_line(), file=sys.stderr)
+        first = False
+
+        conversation.answer(command)
+        prefetch = None
+
+        # users very often ask for an explanation next, so start on it now
+        # rather than when they press e
+        if args.prefetch and command:
+            prefetch = Prefetch(_explain_source(explainer, command, args))
+
+        c = gencmd(
+            command,
+            query,
+            explainer,
+            args,
+            asyncio.get_running_loop(),
+            prefetch,
+            echoed,
+            on_exec=settle,
+        )
+        try:
+            await _in_thread(c.cmdloop)
+        finally:
+            # x never comes back, so anything else means the prefetch is moot
+            if prefetch:
+                prefetch.cancel()
         match c.lastcmd:
             case "q":
                 break
             case "r":
+                # refine whatever the command is now, including manual edits
+                if c.command != command:
+                    conversation.answer(c.command)
                 query = c.query
+                await settle()
+                unstored = revalidation = None
             case _:
                 command = c.command
+    await settle()
 
 
-def main():
+def emit_metrics(llm: Engine, args: dict) -> None:
+    if args.metrics == "json":
+        print(llm.session.to_json(), file=sys.stderr, flush=True)
+
+
+async def run(engines: Dict[str, Engine], query: str, args: dict) -> None:
+    explainer = engines["explain"]
+    try:
+        if args.batch:
+            await explain_batch(explainer, args.batch, args)
+        elif args.generate:
+            await generate(engines["generate"], query, args, explainer)
+        else:
+            await explain(explainer, query, args)
+    finally:
+        # the engines share one session
+        emit_metrics(explainer, args)
+
+
+def build_engines(args: dict) -> Dict[str, Engine]:
+    """An Engine per mode, hosted (--model) or local (--local) as selected"""
+    session = Session()
+    params = {
+        "use_daemon": not args.no_daemon,
+        "session": session,
+        "temperature": args.temperature,
+        "stream": args.stream,
+    }
+    policy = Policy(
+        ttft_timeout=args.ttft_timeout or None,
+        chunk_timeout=args.chunk_timeout or None,
+        retries=args.retries,
+        hedge_percentile=args.hedge,
+    )
+
+    limiter = None
+    if args.rpm or args.tpm:
+        from qq.ratelimit import RateLimiter
+
+        limiter = RateLimiter(args.rpm, args.tpm)
+
+    def resilient(*models: str) -> Engine:
+        engines = [Engine(m, limiter=limiter, **params) for m in models]
+        return ResilientEngine(engines, policy)
+
+    fallbacks = args.fallback.split(",") if args.fallback else []
+    if args.race:
+        # racing is its own fallback, so each contender just gets timeouts and retries
+        hosted = RaceEngine([resilient(m) for m in args.race.split(",")])
+    else:
+        if args.model == "auto":
+            args.model = race.Stats().best(default=DEFAULT_MODEL)
+        hosted = resilient(args.model, *fallbacks)
+    if not args.local:
+        return {"explain": hosted, "generate": hosted}
+
+    from qq import local
+
+    server = local.discover(args.local_url)
+    engine = ResilientEngine([Engine(**server.engine(args.local_model), **params)], policy)
+    modes = ["explain", "generate"] if args.local == "all" else [args.local]
+    if args.generate and "explain" in modes and args.prefetch:
+        # load the model and prime the server's prompt cache while the command
+        # is being generated, so (e)xplain answers straight away
+        _, messages = _explain_request("true", args, engine.model)
+        threading.Thread(
+            target=local.warm,
+            args=(server, args.local_model, messages[:1]),
+            daemon=True,
+        ).start()
+    return {mode: engine if mode in modes else hosted for mode in ("explain", "generate")}
+
+
+# `qq <name> ...` is dispatched to these modules' main() instead of being
+# explained; they're imported on demand to keep startup fast
+SUBCOMMANDS = {
+    "cache": "qq.cache",
+    "daemon": "qq.daemon",
+    "bench": "qq.bench",
+    "local": "qq.local",
+    "index": "qq.index",
+    "warm": "qq.warm",
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="qq: cli explainer and generator using LLMs"
     )
@@ -335,9 +841,64 @@ def main():
     parser.add_argument(
         "-m",
         "--model",
-        # using 4o because claude refuses to output colors properly
-        default="gpt-4o-mini",  # "claude-3-sonnet-20240229"
-        help="Model to use for completion",
+        default=DEFAULT_MODEL,
+        help="Model to use for completion (auto: whichever has been winning --race)",
+    )
+    parser.add_argument(
+        "--race",
+        metavar="MODELS",
+        help="Send each request to these comma-separated models at once and use the fastest",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_const",
+        const="all",
+        help="Use a local model server (llama.cpp, Ollama, ...) instead of --model",
+    )
+    parser.add_argument(
+        "--local-only",
+        dest="local",
+        choices=["explain", "generate"],
+        help="Use the local model server for one mode and --model for the other",
+    )
+    parser.add_argument(
+        "--local-url",
+        default=os.environ.get("QQ_LOCAL_URL"),
+        help="OpenAI-compatible local server for --local (default: probe the usual ports)",
+    )
+    parser.add_argument(
+        "--local-model",
+        default=os.environ.get("QQ_LOCAL_MODEL"),
+        help="Model on the local server (default: the first one it lists)",
+    )
+    parser.add_argument(
+        "--fallback",
+        metavar="MODELS",
+        help="Comma-separated models to try in order if --model keeps failing",
+    )
+    parser.add_argument(
+        "--ttft-timeout",
+        type=float,
+        default=20,
+        help="Seconds to wait for the first token before retrying (0 = forever)",
+    )
+    parser.add_argument(
+        "--chunk-timeout",
+        type=float,
+        default=20,
+        help="Seconds a stream may stall between chunks before giving up (0 = forever)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="Retries per model, with exponential backoff, for failures before the first token",
+    )
+    parser.add_argument(
+        "--hedge",
+        metavar="PERCENTILE",
+        type=float,
+        help="Send a duplicate request when the first token is slower than this percentile of recent ones (e.g. 95)",
     )
     parser.add_argument(
         "-t",
@@ -346,6 +907,17 @@ def main():
         default=0.5,
         help="Temperature for completion",
     )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        help=f"Completion token budget (default {TOKEN_BUDGETS['explain']} for explain, {TOKEN_BUDGETS['generate']} for generate)",
+    )
+    parser.add_argument(
+        "--context-tokens",
+        type=int,
+        default=DEFAULT_MAX_TOKENS,
+        help="Token ceiling for refinement history resent on each (r)eprompt",
+    )
     parser.add_argument(
         "--stream", action="store_true", default=True, help="Stream the output"
     )
@@ -354,6 +926,12 @@ def main():
         action="store_true",
         help="Include environment information in command generation",
     )
+    parser.add_argument(
+        "--no-prefetch",
+        dest="prefetch",
+        action="store_false",
+        help="Don't explain generated commands in the background before (e)xplain is chosen",
+    )
     parser.add_argument(
         "--debug",
         action="store_true",
@@ -364,27 +942,118 @@ def main():
         action="store_false",
         help="Enable color output in the terminal",
     )
+    parser.add_argument(
+        "--format",
+        choices=["text", "json", "ndjson"],
+        default="text",
+        help="Print explanations as text, or as JSON fragment and summary objects for other tools",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Explain from installed man pages, asking the model only about what they don't cover",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Explain from installed man pages only, without calling the model",
+    )
+    parser.add_argument(
+        "--fragments",
+        action="store_true",
+        help="Explain and cache each command of a pipeline separately, so editing one only re-asks about that one",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="Explain every command in a script or history file (- for stdin)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Maximum concurrent requests in --batch mode",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=float,
+        default=os.environ.get("QQ_RPM", 0),
+        help="Limit requests per minute to each hosted model, across every qq process on this machine (0 = no limit)",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=float,
+        default=os.environ.get("QQ_TPM", 0),
+        help="Limit tokens per minute to each hosted model, across every qq process on this machine (0 = no limit)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write the explanation cache",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore cached explanations and overwrite them with fresh ones",
+    )
+    parser.add_argument(
+        "--similarity",
+        type=float,
+        help="How similar (0-1) a description must be to an earlier one to reuse its command with -g (default 0.9)",
+    )
+    parser.add_argument(
+        "--embed-model",
+        default=os.environ.get("QQ_EMBED_MODEL"),
+        help="Embedding model on the local server; turns on -g's semantic cache of commands you ran",
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help="When -g reuses an earlier command, regenerate it in the background to replace it if you run it",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="Run requests in-process even if a qq daemon is running",
+    )
+    parser.add_argument(
+        "--metrics",
+        choices=["json"],
+        help="Print per-request and session metrics to stderr on exit",
+    )
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="Report an import-time breakdown of qq's startup and exit",
+    )
     parser.add_argument(
         "query",
         nargs=argparse.REMAINDER,
         help="Command to explain or description to generate",
     )
-    args = parser.parse_args()
+    return parser
 
-    query = " ".join(args.query)
 
-    llm = partial(
-        litellm.completion,
-        model=args.model,
-        temperature=args.temperature,
-        stream=args.stream,
-    )
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        importlib.import_module(SUBCOMMANDS[sys.argv[1]]).main(sys.argv[2:])
+        return
+
+    args = build_parser().parse_args()
+
+    if args.startup_profile:
+        startup_profile()
+        return
+
+    query = " ".join(args.query)
 
     try:
-        if args.generate:
-            generate(llm, query, args)
-        else:
-            explain(llm, query, args)
+        asyncio.run(run(build_engines(args), query, args))
+    except KeyboardInterrupt:
+        # asyncio.run has already cancelled and closed any in-flight streams
+        print(file=sys.stderr)
+        sys.exit(130)
     except Exception as e:
         print(f"An error occurred: {e}", file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,311 @@
+"""
+Minimal man page reader: finds a command's page on MANPATH and pulls out its
+one-line summary and the options it documents, straight from the roff source
+(both man(7) and mdoc(7) pages), so no `man` binary is needed.
+"""
+
+import bz2
+import functools
+import glob
+import gzip
+import os
+import re
+import shlex
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_MANPATH = [
+    "/usr/local/share/man",
+    "/usr/share/man",
+    "/opt/homebrew/share/man",
+    "/usr/local/man",
+    "/usr/man",
+]
+
+# where commands are documented: user commands, then admin commands, then games
+SECTIONS = ["1", "8", "6"]
+
+
+@dataclass
+class Option:
+    flag: str
+    takes_arg: bool
+    description: str
+
+
+@dataclass
+class Page:
+    name: str
+    summary: str
+    options: Dict[str, Option] = field(default_factory=dict)
+
+    def option(self, flag: str) -> Optional[Option]:
+        return self.options.get(flag)
+
+
+def man_dirs() -> List[str]:
+    """Existing man directories, from $MANPATH (an empty entry means the defaults)"""
+    entries = os.environ["MANPATH"].split(":") if "MANPATH" in os.environ else [""]
+    dirs = []
+    for entry in entries:
+        for path in DEFAULT_MANPATH if entry == "" else [entry]:
+            if os.path.isdir(path) and path not in dirs:
+                dirs.append(path)
+    return dirs
+
+
+def find(command: str) -> Optional[str]:
+    """Path of the man page documenting command, if one is installed"""
+    if not command or "/" in command:
+        return None
+    for section in SECTIONS:
+        for base in man_dirs():
+            # ls.1, ls.1.gz, openssl.1ssl.gz, ...
+            pattern = f"{glob.escape(command)}.{section}*"
+            matches = glob.glob(os.path.join(base, f"man{section}", pattern))
+            if matches:
+                return sorted(matches, key=len)[0]
+    return None
+
+
+def read(path: str) -> str:
+    opener = {".gz": gzip.open, ".bz2": bz2.open}.get(os.path.splitext(path)[1], open)
+    with opener(path, "rt", encoding="utf-8", errors="replace") as fp:
+        return fp.read()
+
+
+# roff escapes, roughly in order of how often they show up in option lists
+_ESCAPES = [
+    (re.compile(r"\\f(\[[^\]]*\]|\(..|.)"), ""),
+    (re.compile(r"\\\(aq"), "'"),
+    (re.compile(r"\\\((lq|rq|dq)"), '"'),
+    (re.compile(r"\\\((em|en|hy)"), "-"),
+    (re.compile(r"\\\(..|\\\[[^\]]*\]|\\\*(\(..|\[[^\]]*\]|.)"), ""),
+    (re.compile(r"\\[-]"), "-"),
+    (re.compile(r"\\[ ~0]"), " "),
+    (re.compile(r"\\e"), "\\\\"),
+    (re.compile(r"\\[&^|,/:%)]"), ""),
+]
+
+# font macros whose arguments are printed without spaces between them
+_ALTERNATING = {"BR", "RB", "BI", "IB", "IR", "RI"}
+
+# mdoc macros that are just punctuation or typesetting around an option list
+_MDOC_DROP = {
+    "Nd", "Op", "Oo", "Oc", "Ns", "Li", "Cm", "Ar", "Pa", "Sy",
+    "Em", "Ql", "Dq", "Sq", "No", "Ic", "Ev", "Va",
+}
+
+
+# requests that only affect layout, never text worth keeping
+_LAYOUT = {
+    "TH", "RS", "RE", "br", "sp", "in", "ti", "ft", "fi", "nf", "ne", "na",
+    "ad", "hy", "nh", "ds", "de", "if", "ie", "el", "nr", "ta", "UR", "UE",
+    "EX", "EE", "Dd", "Dt", "Os", "Bd", "Ed", "An", "Sm",
+}
+
+
+def _unescape(text: str) -> str:
+    for pattern, replacement in _ESCAPES:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def _args(text: str) -> List[str]:
+    try:
+        return shlex.split(text, posix=True)
+    except ValueError:
+        return text.split()
+
+
+def _mdoc(words: List[str]) -> str:
+    """Flatten an mdoc line like `Fl o Ar file` to `-o file`"""
+    out = []
+    flag = False
+    for word in words:
+        if word == "Fl":
+            flag = True
+            continue
+        if word in _MDOC_DROP or word in ("Nm", "It"):
+            continue
+        if flag:
+            word = f"-{word}" if word not in (",", "|") else word
+            flag = False
+        out.append(word)
+    # a bare `Fl` is a lone dash
+    if flag:
+        out.append("-")
+    return " ".join(out).replace(" ,", ",")
+
+
+def _lines(source: str):
+    """(macro, text) for each line of source, with escapes resolved"""
+    for raw in source.splitlines():
+        if raw.startswith(('.\\"', "'\\\"", '.\\#')) or raw in (".", "'"):
+            continue
+        if raw.startswith((".", "'")):
+            macro, _, rest = raw[1:].strip().partition(" ")
+            rest = _unescape(rest)
+            if macro in _ALTERNATING:
+                text = "".join(_args(rest))
+            elif macro in ("B", "I", "SM", "SB"):
+                text = " ".join(_args(rest))
+            elif macro[:1].isupper() and macro[1:2].islower():
+                text = _mdoc([macro] + _args(rest))
+            else:
+                text = rest
+            yield macro, text.strip()
+        else:
+            yield None, _unescape(raw)
+
+
+def _term(term: str) -> List[Option]:
+    """Options named by a term like `-e PATTERNS, --regexp=PATTERNS`"""
+    options = []
+    for variant in re.split(r",\s*|\s+\|\s+", term):
+        words = variant.split()
+        if not words or not re.match(r"^[-+][^\s]", words[0]):
+            continue
+        name = words[0]
+        takes_arg = len(words) > 1
+        eq, bracket = name.find("="), name.find("[")
+        if eq > 0 and (bracket < 0 or eq < bracket):
+            # --lines=NUM, --lines=[-]NUM
+            name, takes_arg = name[:eq], True
+        elif bracket > 0:
+            # --color[=WHEN], -i[SUFFIX]: the argument is optional and attached
+            name = name[:bracket]
+        options.append(Option(name.rstrip(",;:"), takes_arg, ""))
+    # "-n, --lines=NUM": the short spelling takes the argument too
+    if any(o.takes_arg for o in options):
+        for option in options:
+            option.takes_arg = True
+    return options
+
+
+def _sentence(text: str, limit: int = 120) -> str:
+    text = " ".join(text.split())
+    match = re.search(r"(?<=[^\s.])(?<!e\.g)(?<!i\.e)(?<!etc)\.(\s|$)", text)
+    if match:
+        text = text[: match.start()]
+    if len(text) > limit:
+        text = text[: limit - 3].rsplit(" ", 1)[0] + "..."
+    return text[:1].upper() + text[1:]
+
+
+def parse(source: str, name: str = "") -> Page:
+    page = Page(name, "")
+    section = None
+    terms: List[Option] = []
+    description: List[str] = []
+    # set after .TP: the next text line is the term. After .PP it may be one,
+    # if it looks like an option (docbook-generated pages, e.g. git's)
+    want_term = False
+    # inside an mdoc `.It ... Xo` term that continues until `Xc`
+    extended = False
+
+    def flush():
+        text = _sentence(" ".join(description))
+        for option in terms:
+            if text and option.flag not in page.options:
+                option.description = text
+                page.options[option.flag] = option
+        terms.clear()
+        description.clear()
+
+    for macro, text in _lines(source):
+        match macro:
+            case "SH" | "Sh":
+                flush()
+                section = text.strip('"').upper()
+            case "TP" | "HP":
+                flush()
+                want_term = True
+            case "RS" | "RE" if want_term == "maybe":
+                pass
+            case "IP" if not text:
+                # an untagged paragraph carries on the current description
+                pass
+            case "IP" | "It":
+                flush()
+                extended = text.endswith("Xo")
+                terms.extend(_term(text.removesuffix("Xo").strip('"')))
+            case _ if extended:
+                # the rest of the term is the option's argument
+                extended = not text.endswith("Xc")
+                for option in terms:
+                    option.takes_arg = True
+            case "Nd":
+                page.summary = _sentence(text)
+            case "PP" | "P" | "LP":
+                flush()
+                want_term = "maybe"
+            case "Pp" | "SS" | "Ss" | "El" | "Bl":
+                flush()
+            case _ if want_term and text:
+                if want_term is True or text.startswith("-"):
+                    terms.extend(_term(text))
+                else:
+                    description.append(text)
+                want_term = False
+            case _ if macro in _LAYOUT:
+                pass
+            case _:
+                if section == "NAME" and not page.summary and " - " in text:
+                    page.summary = _sentence(text.split(" - ", 1)[1])
+                elif terms and text:
+                    description.append(text)
+    flush()
+    return page
+
+
+def _load(path: str, depth: int = 0) -> str:
+    source = read(path)
+    # pages that are just `.so man1/other.1` aliases
+    first = source.lstrip().split("\n", 1)[0]
+    if first.startswith(".so ") and depth < 3:
+        target = first[4:].strip()
+        root = os.path.dirname(os.path.dirname(path))
+        for candidate in glob.glob(os.path.join(root, target) + "*"):
+            return _load(candidate, depth + 1)
+    return source
+
+
+def load(path: str, command: str) -> Optional[Page]:
+    """Parse the page at path, or None if it documents nothing usable"""
+    try:
+        page = parse(_load(path), command)
+    except (OSError, EOFError, ValueError):
+        return None
+    return page if page.summary or page.options else None
+
+
+def installed() -> Iterator[Tuple[str, str]]:
+    """(command, path) for every command page on MANPATH, preferring pages as find() does"""
+    seen = set()
+    for section in SECTIONS:
+        for base in man_dirs():
+            try:
+                names = sorted(os.listdir(os.path.join(base, f"man{section}")), key=len)
+            except OSError:
+                continue
+            for filename in names:
+                stem = re.sub(r"\.(gz|bz2)$", "", filename)
+                command, dot, suffix = stem.rpartition(".")
+                if dot and suffix.startswith(section) and command not in seen:
+                    seen.add(command)
+                    yield command, os.path.join(base, f"man{section}", filename)
+
+
+@functools.cache
+def lookup(command: str) -> Optional[Page]:
+    """Man page for command, from `qq index` when it's been built, else parsed now"""
+    from qq import index
+
+    db = index.open_index()
+    if db is not None:
+        page = db.page(command)
+        if page is not None:
+            return page
+    path = find(command)
+    return load(path, command) if path else None
@@ -0,0 +1,205 @@
+"""
+Per-request metrics, aggregated per session.
+
+Each request gets a RequestMetrics record; timing is measured by the engine as
+the stream is consumed, and usage/cost are reported by litellm through
+qq.logger.MetricsLogger (or estimated when a stream is cut short and litellm
+never reports on it).
+"""
+
+import asyncio
+import json
+import time
+import uuid
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+# records waiting on litellm's success callback, by litellm_call_id
+_pending = weakref.WeakValueDictionary()
+# where collect() gathers the records started in its context
+_collecting: ContextVar[Optional[List["RequestMetrics"]]] = ContextVar(
+    "collecting", default=None
+)
+
+
+def track(record: "RequestMetrics") -> None:
+    _pending[record.id] = record
+
+
+def lookup(call_id: Optional[str]) -> Optional["RequestMetrics"]:
+    if call_id is None:
+        return None
+    return _pending.get(call_id)
+
+
+@contextmanager
+def collect() -> Iterator[List["RequestMetrics"]]:
+    """
+    The records of requests started within the block, by this task and any it
+    starts, while other tasks share the session
+    """
+    records: List[RequestMetrics] = []
+    token = _collecting.set(records)
+    try:
+        yield records
+    finally:
+        _collecting.reset(token)
+
+
+def cached_tokens(usage) -> int:
+    """Prompt-cache hits from a litellm usage object, for OpenAI or Anthropic"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None)
+    if cached is None:
+        cached = getattr(usage, "cache_read_input_tokens", None)
+    return cached or 0
+
+
+@dataclass(eq=False)
+class RequestMetrics:
+    model: str
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # prompt tokens served from the provider's prompt cache
+    cached_tokens: int = 0
+    ttft: Optional[float] = None
+    latency: Optional[float] = None
+    cost: float = 0.0
+    cache_hit: bool = False
+    # the caller hung up before the stream ended
+    stopped_early: bool = False
+    # seconds spent waiting on the rate limiter before the request went out
+    queued: float = 0.0
+    # usage and cost have been filled in, by litellm or an estimate
+    reported: bool = False
+    _start: float = field(default_factory=time.monotonic, repr=False)
+
+    def first_token(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self._start
+
+    def finish(self) -> None:
+        if self.latency is None:
+            self.latency = time.monotonic() - self._start
+
+    def report(
+        self,
+        cost: float,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int = 0,
+    ) -> None:
+        self.cost = float(cost or 0)
+        self.prompt_tokens = int(prompt_tokens or 0)
+        self.completion_tokens = int(completion_tokens or 0)
+        self.cached_tokens = int(cached_tokens or 0)
+        self.reported = True
+
+    async def settle(self, timeout: float = 0.5) -> bool:
+        """
+        Wait briefly for litellm's success callback, which fires after the
+        stream ends (sometimes on another thread)
+        """
+        deadline = time.monotonic() + timeout
+        while not self.reported and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return self.reported
+
+    @property
+    def tokens_per_sec(self) -> Optional[float]:
+        if self.latency is None or self.ttft is None or not self.completion_tokens:
+            return None
+        generating = self.latency - self.ttft
+        return self.completion_tokens / generating if generating > 0 else None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "model": self.model,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "ttft": self.ttft,
+            "latency": self.latency,
+            "tokens_per_sec": self.tokens_per_sec,
+            "cost": self.cost,
+            "cache_hit": self.cache_hit,
+            "stopped_early": self.stopped_early,
+            "queued": self.queued,
+        }
+
+
+class Session:
+    """All the requests made by one qq invocation"""
+
+    def __init__(self):
+        self.requests: List[RequestMetrics] = []
+
+    def start(self, model: str) -> RequestMetrics:
+        record = RequestMetrics(model)
+        self.requests.append(record)
+        track(record)
+        collecting = _collecting.get()
+        if collecting is not None:
+            collecting.append(record)
+        return record
+
+    def cache_hit(self, model: str) -> RequestMetrics:
+        record = RequestMetrics(model, cache_hit=True, reported=True)
+        record.first_token()
+        record.finish()
+        self.requests.append(record)
+        return record
+
+    @property
+    def cost(self) -> float:
+        return sum(r.cost for r in self.requests)
+
+    @property
+    def stopped_early(self) -> int:
+        return sum(r.stopped_early for r in self.requests)
+
+    @property
+    def cached_tokens(self) -> int:
+        return sum(r.cached_tokens for r in self.requests)
+
+    @property
+    def queued(self) -> float:
+        return sum(r.queued for r in self.requests)
+
+    def cost_line(self) -> str:
+        notes = []
+        if self.queued:
+            notes.append(f"queued {self.queued:.1f}s for rate limits")
+        if self.cached_tokens:
+            notes.append(f"{self.cached_tokens} prompt tokens cached")
+        if self.stopped_early:
+            notes.append(f"{self.stopped_early} stopped early")
+        if self.requests and self.requests[-1].cache_hit:
+            notes.append("cached")
+        note = f" ({', '.join(notes)})" if notes else ""
+        return f"\033[1;37mCost ${self.cost:.4f}{note}\033[0m "
+
+    def summary(self) -> dict:
+        ttfts = [r.ttft for r in self.requests if r.ttft is not None and not r.cache_hit]
+        return {
+            "requests": [r.to_dict() for r in self.requests],
+            "totals": {
+                "requests": len(self.requests),
+                "cache_hits": sum(r.cache_hit for r in self.requests),
+                "prompt_tokens": sum(r.prompt_tokens for r in self.requests),
+                "completion_tokens": sum(r.completion_tokens for r in self.requests),
+                "cached_tokens": self.cached_tokens,
+                "stopped_early": self.stopped_early,
+                "queued": self.queued,
+                "cost": self.cost,
+                "mean_ttft": sum(ttfts) / len(ttfts) if ttfts else None,
+            },
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary())
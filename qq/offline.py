@@ -0,0 +1,464 @@
+"""
+Explanations built from installed man pages instead of a model.
+
+explain() splits a command line into stages (simple commands) and the operators
+between them, then looks each command and flag up with qq.manpages. Stages it
+can't fully account for are marked unresolved, so the caller can ask the model
+about just those. render() and summary() lay the result out like the examples
+in EXPLAIN_PROMPT, for qq.highlight to color.
+"""
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Tuple
+
+from qq import manpages
+from qq.highlight import INDENT, SEPARATOR
+from qq.manpages import Option, Page
+
+OPERATORS = {
+    "|": "Pipe the output of the previous command to the next one",
+    "|&": "Pipe the output and errors of the previous command to the next one",
+    "&&": "Run the next command only if the previous one succeeds",
+    "||": "Run the next command only if the previous one fails",
+    ";": "Then run the next command",
+    "&": "Run the previous command in the background",
+    "(": "Start a subshell",
+    ")": "End of the subshell",
+}
+
+REDIRECTS = {
+    ">": "Write output to",
+    ">>": "Append output to",
+    "<": "Read input from",
+    "&>": "Write output and errors to",
+    ">&": "Send output to",
+    "<<<": "Use this string as input:",
+    ">|": "Overwrite, even with noclobber set,",
+}
+
+# how summary() reads an operator between two commands
+CONNECTORS = {
+    "|": "piped into",
+    "|&": "piped into",
+    "&&": "and then",
+    "||": "or else",
+    ";": "then",
+    "&": "in the background, then",
+}
+
+# commands whose arguments are another command line
+WRAPPERS = {
+    "sudo", "doas", "env", "nohup", "time", "nice", "exec", "command", "xargs",
+    "watch", "timeout",
+}
+
+# shell builtins have no man page of their own
+BUILTINS = {
+    "cd": "Change the working directory",
+    "export": "Set environment variables for this shell and its children",
+    "source": "Run a file's commands in the current shell",
+    ".": "Run a file's commands in the current shell",
+    "alias": "Define a command alias",
+    "unset": "Remove variables or functions",
+    "set": "Set shell options and positional parameters",
+    "eval": "Run its arguments as a shell command",
+    "exit": "Exit the shell",
+    "pushd": "Push a directory onto the directory stack and change to it",
+    "popd": "Pop a directory off the directory stack and change to it",
+    "read": "Read a line from standard input into variables",
+    "wait": "Wait for background jobs to finish",
+    "trap": "Run a command when the shell receives a signal",
+}
+
+# compound commands, which are one command however many separators they hold
+OPENERS = {
+    "if": "fi", "case": "esac", "for": "done", "while": "done", "until": "done",
+    "select": "done", "{": "}",
+}
+CLOSERS = set(OPENERS.values())
+# reserved words that are followed by another command rather than arguments
+LEADERS = {"if", "then", "else", "elif", "while", "until", "do", "{", "!", "time"}
+
+_ASSIGNMENT = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*=")
+_PUNCTUATION = re.compile(r"^[();<>|&]+$")
+_REDIRECT = re.compile(
+    "^([0-9]*)(%s)(.*)$" % "|".join(map(re.escape, sorted(REDIRECTS, key=len, reverse=True))),
+    re.DOTALL,
+)
+_TOKEN = re.compile(
+    r"""
+    (?P<space>[^\S\n]+|\\\n)
+    | (?P<newline>\n)
+    | (?P<comment>\#[^\n]*)
+    | (?P<punctuation>[();<>|&]+)
+    | (?P<word>(?:[^\s();<>|&'"`\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*"|`[^`]*`)+)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+@dataclass
+class Fragment:
+    # as typed, with the option's argument or the redirect's target if any
+    text: str
+    role: str
+    description: str
+    depth: int = 0
+    # the option's argument, or the redirect's target
+    arg: Optional[str] = None
+
+
+@dataclass
+class Stage:
+    text: str
+    depth: int
+    fragments: List[Fragment] = field(default_factory=list)
+    resolved: bool = True
+    # (name, summary) of the command this stage runs, for summary()
+    command: Optional[Tuple[str, str]] = None
+    operator: Optional[str] = None
+
+
+def _lex(command: str) -> Tuple[List[str], List[int]]:
+    """Raw words and runs of punctuation, with where each one ends"""
+    raw, ends = [], []
+    pos = 0
+    while pos < len(command):
+        token = _TOKEN.match(command, pos)
+        if token is None:
+            if command[pos] == "\\":
+                raise ValueError("No escaped character")
+            raise ValueError("No closing quotation")
+        pos = token.end()
+        if token.lastgroup in ("word", "punctuation", "newline"):
+            raw.append(token.group())
+            ends.append(pos)
+    return raw, ends
+
+
+def tokenize(command: str) -> List[str]:
+    """
+    Shell words and operators, quotes and escapes kept as written (`\\;` is
+    find's argument, not a separator). $(...) and `...` stay single words, and
+    redirects stick to their fd and target as written (2>&1). Newlines come as "\\n" tokens.
+    """
+    # where each token ends, to tell `2>&1` from `head -n 5 > out`
+    raw, ends = _lex(command)
+
+    tokens = []
+    i = 0
+    while i < len(raw):
+        token = raw[i]
+        if token.endswith("$") and i + 1 < len(raw) and raw[i + 1].startswith("("):
+            # command substitution: gather up to the matching paren
+            depth = 0
+            parts = [token]
+            i += 1
+            while i < len(raw):
+                depth += raw[i].count("(") - raw[i].count(")")
+                parts.append(raw[i])
+                if depth <= 0:
+                    break
+                i += 1
+            tokens.append(parts[0] + " ".join(parts[1:]).replace("( ", "(").replace(" )", ")"))
+        elif token in REDIRECTS or (
+            token.isdigit()
+            and i + 1 < len(raw)
+            and raw[i + 1] in REDIRECTS
+            and command.startswith(raw[i + 1], ends[i])
+        ):
+            if token.isdigit():
+                token += raw[i + 1]
+                i += 1
+            # and so does a target written right after it (2>/dev/null)
+            if (
+                i + 1 < len(raw)
+                and not _PUNCTUATION.match(raw[i + 1])
+                and command.startswith(raw[i + 1], ends[i])
+            ):
+                token += raw[i + 1]
+                i += 1
+            tokens.append(token)
+        elif _PUNCTUATION.match(token) and token not in OPERATORS and token not in REDIRECTS:
+            # adjacent punctuation comes as one run, e.g. `);`
+            tokens.extend(_split_punctuation(token))
+        else:
+            tokens.append(token)
+        i += 1
+    return tokens
+
+
+def _split_punctuation(token: str) -> List[str]:
+    # ;; ends a case branch
+    known = sorted([*OPERATORS, *REDIRECTS, ";;"], key=len, reverse=True)
+    parts = []
+    while token:
+        op = next((op for op in known if token.startswith(op)), token[0])
+        parts.append(op)
+        token = token[len(op) :]
+    return parts
+
+
+def _redirect(token: str) -> Optional[Tuple[str, str, str]]:
+    """(fd, operator, target) of a redirect word; target is "" if it's the next word"""
+    match = _REDIRECT.match(token)
+    return match.groups() if match else None
+
+
+def _redirection(fd: str, op: str, target: Optional[str]) -> str:
+    streams = {"1": "standard output", "2": "standard error"}
+    if op == ">&" and target in streams:
+        return f"Send {streams.get(fd or '1')} to {streams[target]}"
+    what = f"{REDIRECTS[op]} {target}" if target else REDIRECTS[op]
+    return what.replace("output", "errors", 1) if fd == "2" else what
+
+
+def _options(page: Page, word: str) -> Optional[List[Tuple[str, Option, Optional[str]]]]:
+    """
+    (spelling, option, inline argument) for each option in word, where
+    spelling is its part of word, argument included
+    """
+    option = page.option(word)
+    if option:
+        return [(word, option, None)]
+    if word.startswith("--") and "=" in word:
+        flag, value = word.split("=", 1)
+        option = page.option(flag)
+        return [(word, option, value)] if option else None
+    if word.startswith("-") and not word.startswith("--") and len(word) > 2:
+        # bundled short options (-la), possibly ending in an argument (-n5)
+        found = []
+        for k in range(1, len(word)):
+            flag = f"-{word[k]}"
+            option = page.option(flag)
+            if option is None:
+                return None
+            rest = word[k + 1 :]
+            if option.takes_arg and rest:
+                found.append((flag + rest, option, rest))
+                break
+            found.append((flag, option, None))
+        return found
+    return None
+
+
+def _argument(word: str, depth: int) -> Fragment:
+    if word[:1] in "'\"":
+        return Fragment(word, "string", "Quoted argument", depth)
+    if word.startswith(("$(", "`")):
+        return Fragment(word, "argument", "Output of a command substitution", depth)
+    if word.startswith("$"):
+        return Fragment(word, "argument", "Value of a shell variable", depth)
+    path = os.path.expanduser(word)
+    if os.path.isdir(path):
+        return Fragment(word, "argument", "Existing directory", depth)
+    if os.path.exists(path):
+        return Fragment(word, "argument", "Existing file", depth)
+    if any(c in word for c in "*?["):
+        return Fragment(word, "argument", "Glob pattern", depth)
+    return Fragment(word, "argument", "Argument", depth)
+
+
+def _stage(words: List[str], depth: int) -> Stage:
+    stage = Stage(" ".join(words), depth)
+    i = 0
+    while i < len(words) and _ASSIGNMENT.match(words[i]):
+        name = words[i].split("=", 1)[0]
+        stage.fragments.append(
+            Fragment(words[i], "assignment", f"Set {name} in the command's environment", depth)
+        )
+        i += 1
+    if i == len(words):
+        return stage
+
+    name = words[i]
+    if name in OPENERS:
+        # a loop or if: the model's to explain as a whole
+        stage.resolved = False
+        stage.fragments.append(Fragment(" ".join(words[i:]), "command", "", depth))
+        return stage
+    page = manpages.lookup(os.path.basename(name))
+    if page is None and name in BUILTINS:
+        page = Page(name, BUILTINS[name])
+    # git commit, docker run, ...: prefer the subcommand's own page
+    if i + 1 < len(words) and re.match(r"^[a-z][a-z0-9-]*$", words[i + 1]):
+        sub = manpages.lookup(f"{os.path.basename(name)}-{words[i + 1]}")
+        if sub is not None:
+            name, page = f"{name} {words[i + 1]}", sub
+            i += 1
+    if page is None or not page.summary:
+        stage.resolved = False
+        stage.fragments.append(Fragment(" ".join(words[i:]), "command", "", depth))
+        return stage
+    stage.command = (name, page.summary)
+    stage.fragments.append(Fragment(name, "command", page.summary, depth))
+
+    rest = words[i + 1 :]
+    j = 0
+    while j < len(rest):
+        word = rest[j]
+        redirect = _redirect(word)
+        if redirect:
+            fd, op, target = redirect
+            if not target and j + 1 < len(rest):
+                j += 1
+                target = rest[j]
+                word = f"{word} {target}"
+            what = _redirection(fd, op, target or None)
+            stage.fragments.append(Fragment(word, "redirect", what, depth + 1, target or None))
+            j += 1
+            continue
+        if word == "--":
+            stage.fragments.append(Fragment(word, "operator", "End of options", depth + 1))
+        elif word.startswith("-") and len(word) > 1:
+            options = _options(page, word)
+            if options is None:
+                stage.resolved = False
+                stage.fragments.append(Fragment(word, "option", "", depth + 1))
+            for spelling, option, value in options or []:
+                if option.takes_arg and value is None and j + 1 < len(rest):
+                    j += 1
+                    value = rest[j]
+                    spelling = f"{spelling} {value}"
+                stage.fragments.append(
+                    Fragment(spelling, "option", option.description, depth + 1, value)
+                )
+        elif os.path.basename(name) in WRAPPERS:
+            inner = _stage(rest[j:], depth + 1)
+            stage.fragments.extend(inner.fragments)
+            stage.resolved = stage.resolved and inner.resolved
+            break
+        else:
+            stage.fragments.append(_argument(word, depth + 1))
+        j += 1
+    return stage
+
+
+def operator(token: str, depth: int = 0) -> Stage:
+    stage = Stage(token, depth, operator=token)
+    stage.fragments.append(Fragment(token, "operator", OPERATORS[token], depth))
+    return stage
+
+
+def _walk(command: str) -> Iterator[Tuple[str, bool]]:
+    """
+    command's tokens, each with whether it's outside any compound command
+    (for/done, if/fi, {/}, ...), where its operators separate commands.
+    Newlines between commands come as "\\n"; inside a compound command they
+    become `;`, and ones that only continue a line (after `|`, `do`, ...) are
+    dropped.
+    """
+    compound = 0
+    # a command starts here, so a reserved word is one
+    leading = True
+    for token in tokenize(command):
+        if token == "\n":
+            if not leading:
+                yield (";", False) if compound else ("\n", True)
+                leading = True
+            continue
+        if token in OPERATORS or token == ";;":
+            yield token, compound == 0
+            leading = token != ")"
+            continue
+        if leading and token in OPENERS:
+            compound += 1
+        elif leading and token in CLOSERS:
+            compound = max(0, compound - 1)
+        leading = leading and token in LEADERS
+        yield token, False
+
+
+def split(command: str) -> List[str]:
+    """
+    command cut at its top-level newlines, pipes and separators (|, &&, ;,
+    ...) into commands and the operators between them, in order. Compound
+    commands, subshells and command substitutions stay whole, and words are
+    rejoined with single spaces.
+    """
+    parts = []
+    words: List[str] = []
+    depth = 0
+    for token, top in _walk(command):
+        if top and depth == 0 and (token == "\n" or token in CONNECTORS):
+            if words:
+                parts.append(" ".join(words))
+                words = []
+            if token != "\n":
+                parts.append(token)
+            continue
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth = max(0, depth - 1)
+        words.append(token)
+    if words:
+        parts.append(" ".join(words))
+    return parts
+
+
+def explain(command: str) -> List[Stage]:
+    """
+    command's stages and the operators between them, in order. Lines are
+    separate stages, and a compound command (loop, if, ...) is one.
+    """
+    stages = []
+    words: List[str] = []
+    depth = 0
+
+    def finish():
+        if words:
+            stages.append(_stage(list(words), depth))
+            words.clear()
+
+    for token, top in _walk(command):
+        if token == "\n":
+            finish()
+        elif token in OPERATORS and top:
+            finish()
+            if token == ")":
+                depth = max(0, depth - 1)
+            stages.append(operator(token, depth))
+            if token == "(":
+                depth += 1
+        else:
+            words.append(token)
+    finish()
+    return stages
+
+
+def resolved(stages: List[Stage]) -> bool:
+    return all(stage.resolved for stage in stages)
+
+
+def render(stage: Stage) -> str:
+    """The stage's lines, each ending in a newline, in the plain explain format"""
+    lines = []
+    for fragment in stage.fragments:
+        description = fragment.description or "No local documentation for this"
+        lines.append(f"{INDENT * fragment.depth}{fragment.text}{SEPARATOR}{description}\n")
+    return "".join(lines)
+
+
+def summary(stages: List[Stage]) -> str:
+    """One line describing the whole command, from each command's man page summary"""
+    parts = []
+    connector = None
+    for stage in stages:
+        if stage.operator in CONNECTORS:
+            connector = CONNECTORS[stage.operator]
+        elif stage.command:
+            name, about = stage.command
+            if about[1:2].islower():
+                about = about[:1].lower() + about[1:]
+            part = f"{name} ({about})"
+            parts.append(f"{connector} {part}" if parts and connector else part)
+            connector = None
+        elif stage.text and not stage.operator:
+            parts.append(f"{connector} {stage.text}" if parts and connector else stage.text)
+            connector = None
+    if not parts:
+        return ""
+    return f"This runs {', '.join(parts)}."
@@ -0,0 +1,163 @@
+"""
+Racing several models against each other.
+
+`--race m1,m2,...` sends each request to every model at once, streams whichever
+produces usable output first and closes the others. Who won and how long it
+took is kept in race.json in the cache dir, and `--model auto` picks the model
+that has been winning.
+"""
+
+import asyncio
+import json
+import os
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from qq.cache import cache_dir, update_json
+from qq.engine import Engine
+from qq.metrics import Session
+from qq.stream import CommandParser
+
+# models need this many races before --model auto trusts their record
+MIN_RACES = 3
+# weight of the latest win in a model's running latency
+ALPHA = 0.2
+
+
+def stats_path() -> str:
+    return os.path.join(cache_dir(), "race.json")
+
+
+class Stats:
+    """Per-model races entered, races won and smoothed latency of wins"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or stats_path()
+        try:
+            with open(self.path) as fp:
+                self.models: Dict[str, dict] = json.load(fp)
+        except (OSError, ValueError):
+            self.models = {}
+
+    def record(self, models: List[str], winner: str, latency: float) -> None:
+        """Add a race to the stats on disk, as other processes may have too"""
+        with update_json(self.path) as stats:
+            for model in models:
+                entry = stats.setdefault(model, {"races": 0, "wins": 0, "latency": None})
+                entry["races"] += 1
+            entry = stats[winner]
+            entry["wins"] += 1
+            previous = entry["latency"]
+            entry["latency"] = (
+                latency if previous is None else ALPHA * latency + (1 - ALPHA) * previous
+            )
+        self.models = stats
+
+    def best(self, default: str) -> str:
+        """The model winning most often, the fastest of those on a tie"""
+        ranked = [
+            (entry["wins"] / entry["races"], -(entry["latency"] or float("inf")), model)
+            for model, entry in self.models.items()
+            if entry["races"] >= MIN_RACES
+        ]
+        return max(ranked)[2] if ranked else default
+
+
+def first_text(text: str, done: bool) -> bool:
+    """Explanations are usable as soon as they start"""
+    return bool(text.strip())
+
+
+def command_ready(text: str, done: bool) -> bool:
+    """Generations are usable once they hold a whole <command> block"""
+    if CommandParser.CLOSE in text:
+        return True
+    # the provider stops at </command> itself, so the stream just ends
+    return done and CommandParser.OPEN in text
+
+
+class _Lost(Exception):
+    pass
+
+
+class RaceEngine(Engine):
+    """An Engine that sends every request to several engines and keeps the fastest"""
+
+    def __init__(self, engines: List[Engine], session: Optional[Session] = None):
+        super().__init__(
+            "race:" + ",".join(e.model for e in engines),
+            use_daemon=False,
+            session=session or engines[0].session,
+        )
+        self.engines = engines
+
+    async def _contend(self, engine: Engine, messages, ready, overrides):
+        """Read engine's stream until it's usable; return it still open"""
+        stream = engine.stream(messages, **overrides)
+        chunks = []
+        text = ""
+        try:
+            async for content in stream:
+                chunks.append(content)
+                text += content
+                if ready(text, False):
+                    return engine, stream, chunks, False
+            if ready(text, True):
+                return engine, stream, chunks, True
+            raise _Lost(f"{engine.model} gave no usable output")
+        except BaseException:
+            await stream.aclose()
+            raise
+
+    async def stream(
+        self,
+        messages: List[Dict],
+        ready: Callable[[str, bool], bool] = first_text,
+        **overrides,
+    ) -> AsyncIterator[str]:
+        start = time.monotonic()
+        tasks = [
+            asyncio.create_task(self._contend(engine, messages, ready, overrides))
+            for engine in self.engines
+        ]
+        winner = None
+        error = None
+        try:
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # a contender that finished in the same instant as the winner
+            # still holds an open stream
+            for task in tasks:
+                if not task.cancelled() and task.exception() is None:
+                    if winner is None or task.result()[1] is not winner[1]:
+                        await task.result()[1].aclose()
+
+        if winner is None:
+            raise error or _Lost("no model gave usable output")
+
+        engine, stream, chunks, finished = winner
+        try:
+            Stats().record(
+                [e.model for e in self.engines], engine.model, time.monotonic() - start
+            )
+        except OSError:
+            pass
+
+        async with aclosing(stream):
+            for content in chunks:
+                yield content
+            if not finished:
+                async for content in stream:
+                    yield content
@@ -0,0 +1,100 @@
+"""
+Client-side rate limits shared by every qq process on the machine.
+
+When many people or CI jobs run qq from one API key they share its provider
+limits too, and going over them means 429s. Each provider/model gets a pair of
+token buckets, requests and tokens per minute, kept in ratelimit.json in the
+cache dir and only read or written under an flock, so concurrent processes
+draw on the same budget. A request that would overdraw a bucket takes its
+share anyway and sleeps until the bucket has refilled that far, so requests
+queue up in the order they arrived instead of failing.
+
+Token counts aren't known until a response is done, so each request is
+charged an estimate up front (its prompt plus max_tokens) and the difference
+is settled once litellm reports usage.
+"""
+
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional
+
+from qq.cache import cache_dir, update_json
+
+
+def state_path() -> str:
+    return os.path.join(cache_dir(), "ratelimit.json")
+
+
+def provider_of(model: str) -> str:
+    """Rough provider name for a litellm model string"""
+    if "/" in model:
+        return model.split("/", 1)[0]
+    if model.startswith("claude"):
+        return "anthropic"
+    if model.startswith(("gpt", "o1", "o3", "o4", "chatgpt")):
+        return "openai"
+    return model
+
+
+def key_for(model: str) -> str:
+    """Providers apply limits per model, so that's what buckets are kept by"""
+    return model if "/" in model else f"{provider_of(model)}/{model}"
+
+
+class RateLimiter:
+    """Requests- and tokens-per-minute buckets per model, shared across processes"""
+
+    def __init__(self, rpm: float = 0, tpm: float = 0, path: Optional[str] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.path = path or state_path()
+
+    def estimate(self, messages: List[Dict], max_tokens: Optional[int] = None) -> int:
+        """Tokens to charge up front: ~4 characters a token, plus the whole budget"""
+        chars = sum(len(str(m.get("content") or "")) for m in messages)
+        return chars // 4 + (max_tokens or 0)
+
+    def _take(self, model: str, requests: int, tokens: int) -> float:
+        """
+        Take from model's buckets (a negative amount gives back); returns
+        seconds until they're out of debt
+        """
+        key = key_for(model)
+        with update_json(self.path) as state:
+            now = time.time()
+            bucket = state.get(key) or {"updated": now}
+            elapsed = max(0.0, now - bucket["updated"])
+            wait = 0.0
+            for name, limit, amount in (
+                ("requests", self.rpm, requests),
+                ("tokens", self.tpm, tokens),
+            ):
+                if not limit:
+                    continue
+                rate = limit / 60
+                level = min(limit, bucket.get(name, limit) + rate * elapsed)
+                level = min(limit, level - amount)
+                bucket[name] = level
+                if level < 0:
+                    wait = max(wait, -level / rate)
+            bucket["updated"] = now
+            state[key] = bucket
+        return wait
+
+    async def acquire(self, model: str, tokens: int) -> float:
+        """Wait for room for one request of tokens to model; returns seconds waited"""
+        wait = self._take(model, 1, tokens)
+        if wait:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # never sent, so its place goes to whoever's next
+                self._take(model, -1, -tokens)
+                raise
+        return wait
+
+    def settle(self, model: str, charged: int, used: int) -> None:
+        """Correct the up-front estimate once the real token count is known"""
+        if self.tpm and used != charged:
+            self._take(model, 0, used - charged)
@@ -0,0 +1,95 @@
+"""
+Terminal output for streamed responses.
+
+Printing each chunk as it arrives costs a write syscall per token, and a chunk
+can end halfway through an ANSI escape sequence (`\\033[1;3` ... `4m`), which
+terminals show as stray characters until the rest turns up. A Renderer
+gathers chunks for up to a frame (or a few KB), holds back an escape sequence
+until it's complete, and writes what's ready straight to stdout's file
+descriptor in one go.
+"""
+
+import asyncio
+import io
+import os
+import re
+import sys
+from typing import Optional, TextIO
+
+# about one frame at 60Hz; slower than this and streaming starts to look jerky
+WINDOW = 0.016
+MAX_BYTES = 4096
+
+# the tail of a CSI escape sequence that hasn't reached its final byte yet
+_INCOMPLETE = re.compile(r"\033(?:\[[0-?]*[ -/]*)?")
+
+
+class Renderer:
+    """
+    Coalesce streamed text into few writes. write() only buffers; what's
+    buffered goes out `window` seconds after the first pending chunk, once
+    max_bytes are waiting, or on close(). window=0 writes every chunk at once.
+    """
+
+    def __init__(
+        self,
+        out: Optional[TextIO] = None,
+        window: float = WINDOW,
+        max_bytes: int = MAX_BYTES,
+    ):
+        self.out = out or sys.stdout
+        self.window = window
+        self.max_bytes = max_bytes
+        try:
+            self.fd = self.out.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self.fd = None
+        self.pending = ""
+        # write syscalls made, for qq bench
+        self.writes = 0
+        self._timer = None
+
+    def write(self, text: str) -> None:
+        self.pending += text
+        if not self.window or len(self.pending) >= self.max_bytes:
+            self.flush()
+        elif self._timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self._timer = loop.call_later(self.window, self.flush)
+
+    def flush(self, final: bool = False) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        text, self.pending = self.pending, ""
+        escape = text.rfind("\033")
+        if not final and escape >= 0 and _INCOMPLETE.fullmatch(text, escape):
+            text, self.pending = text[:escape], text[escape:]
+        if text:
+            self._emit(text)
+
+    def _emit(self, text: str) -> None:
+        # anything print()ed before us has to come out first
+        self.out.flush()
+        if self.fd is None:
+            self.out.write(text)
+            self.out.flush()
+            self.writes += 1
+            return
+        data = text.encode(getattr(self.out, "encoding", None) or "utf-8", "replace")
+        while data:
+            data = data[os.write(self.fd, data) :]
+            self.writes += 1
+
+    def close(self) -> None:
+        self.flush(final=True)
+
+    def __enter__(self) -> "Renderer":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,216 @@
+"""
+Timeouts, hedging, retries and fallbacks around an Engine.
+
+A ResilientEngine tries a chain of engines (the requested model, then any
+fallbacks) in order. Each attempt must produce its first token within
+ttft_timeout and every later chunk within chunk_timeout. With hedging on, a
+duplicate request is sent once the first token is slower than the given
+percentile of that model's recent time to first token, and whichever answers
+first is used. Failures before the first token are retried with exponential
+backoff; once output has been shown, errors are final.
+"""
+
+import asyncio
+import json
+import os
+import random
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional
+
+from qq.cache import cache_dir, update_json
+from qq.engine import Engine
+
+# HTTP statuses worth another try
+TRANSIENT_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# recent times to first token kept per model, and how many hedging needs
+HISTORY = 50
+MIN_SAMPLES = 10
+
+
+class StreamTimeout(TimeoutError):
+    pass
+
+
+@dataclass
+class Policy:
+    ttft_timeout: Optional[float] = 20.0
+    chunk_timeout: Optional[float] = 20.0
+    retries: int = 2
+    backoff: float = 0.5
+    # hedge once the first token is slower than this percentile (e.g. 95)
+    hedge_percentile: Optional[float] = None
+
+
+def transient(error: BaseException) -> bool:
+    """Rate limits, timeouts, overload and connection trouble, but not bad requests"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    name = type(error).__name__
+    words = ("RateLimit", "Timeout", "APIConnection", "ServiceUnavailable", "InternalServer")
+    return any(word in name for word in words)
+
+
+class History:
+    """Recent times to first token per model, persisted in the cache dir"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(cache_dir(), "latency.json")
+        try:
+            with open(self.path) as fp:
+                self.samples: Dict[str, List[float]] = json.load(fp)
+        except (OSError, ValueError):
+            self.samples = {}
+
+    def percentile(self, model: str, p: float) -> Optional[float]:
+        samples = sorted(self.samples.get(model, []))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def add(self, model: str, ttft: float) -> None:
+        try:
+            # other processes add samples too, so start from what's on disk
+            with update_json(self.path) as samples:
+                samples[model] = (samples.get(model, []) + [ttft])[-HISTORY:]
+        except OSError:
+            self.samples[model] = (self.samples.get(model, []) + [ttft])[-HISTORY:]
+        else:
+            self.samples = samples
+
+
+async def _opened(stream: AsyncIterator[str]):
+    """Wait for stream's first chunk, leaving the stream open for the rest"""
+    try:
+        return stream, await stream.__anext__()
+    except StopAsyncIteration:
+        return stream, None
+    except BaseException:
+        await stream.aclose()
+        raise
+
+
+class ResilientEngine(Engine):
+    """An Engine that retries, hedges and falls back across a chain of engines"""
+
+    def __init__(self, engines: List[Engine], policy: Policy):
+        super().__init__(engines[0].model, use_daemon=False, session=engines[0].session)
+        self.engines = engines
+        self.policy = policy
+        self.history = History() if policy.hedge_percentile else None
+
+    async def _start(self, engine: Engine, messages, overrides):
+        """
+        Open engine's stream and wait for its first chunk, hedging with a
+        duplicate request if that's slow. The clock starts when the request
+        leaves the rate limiter's queue. Returns (stream, first chunk).
+        """
+        loop = asyncio.get_running_loop()
+        delay = None
+        if self.history:
+            delay = self.history.percentile(engine.model, self.policy.hedge_percentile)
+
+        tasks = []
+        # when each request was actually sent
+        sent_at = []
+        sent = asyncio.Event()
+
+        def launch():
+            i = len(tasks)
+            sent_at.append(None)
+
+            def on_sent():
+                sent_at[i] = loop.time()
+                sent.set()
+
+            stream = engine.stream(messages, sent=on_sent, **overrides)
+            tasks.append(asyncio.create_task(_opened(stream)))
+
+        launch()
+        waiter = asyncio.create_task(sent.wait())
+        winner = None
+        error = None
+        try:
+            while winner is None:
+                pending = [t for t in tasks if not t.done()]
+                if not pending:
+                    raise error
+                deadline = hedge_at = None
+                if sent_at[0] is not None:
+                    if self.policy.ttft_timeout:
+                        deadline = sent_at[0] + self.policy.ttft_timeout
+                    if delay is not None and len(tasks) == 1:
+                        hedge_at = sent_at[0] + delay
+                wake = [t for t in (deadline, hedge_at) if t is not None]
+                timeout = max(0, min(wake) - loop.time()) if wake else None
+                done, _ = await asyncio.wait(
+                    pending + ([] if waiter.done() else [waiter]),
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task is waiter:
+                        continue
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                if winner is not None:
+                    break
+                now = loop.time()
+                if deadline is not None and now >= deadline:
+                    raise StreamTimeout(
+                        f"{engine.model}: no response in {self.policy.ttft_timeout:g}s"
+                    )
+                if hedge_at is not None and now >= hedge_at:
+                    launch()
+        finally:
+            waiter.cancel()
+            for task in tasks:
+                if task is not winner and not task.done():
+                    task.cancel()
+            losers = [t for t in tasks if t is not winner]
+            await asyncio.gather(*losers, return_exceptions=True)
+            for task in losers:
+                if not task.cancelled() and task.exception() is None:
+                    await task.result()[0].aclose()
+
+        if self.history:
+            self.history.add(engine.model, loop.time() - sent_at[tasks.index(winner)])
+        return winner.result()
+
+    async def _attempt(self, messages, overrides):
+        """(stream, first chunk) from the first engine in the chain that answers"""
+        error = None
+        for engine in self.engines:
+            for attempt in range(self.policy.retries + 1):
+                if attempt:
+                    delay = self.policy.backoff * 2 ** (attempt - 1)
+                    await asyncio.sleep(delay + random.uniform(0, delay))
+                try:
+                    return await self._start(engine, messages, overrides)
+                except Exception as e:
+                    error = e
+                    if not transient(e):
+                        break
+        raise error
+
+    async def stream(self, messages: List[Dict], **overrides) -> AsyncIterator[str]:
+        stream, content = await self._attempt(messages, overrides)
+        try:
+            while content is not None:
+                yield content
+                try:
+                    content = await asyncio.wait_for(
+                        stream.__anext__(), self.policy.chunk_timeout
+                    )
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise StreamTimeout(
+                        f"{self.model}: stalled for {self.policy.chunk_timeout:g}s"
+                    ) from None
+        finally:
+            await stream.aclose()
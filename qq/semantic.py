@@ -0,0 +1,160 @@
+"""
+Semantic cache for generated commands.
+
+Descriptions passed to `qq -g` repeat in meaning more than in wording, so
+instead of keying on the exact text, each (description, command) pair is
+stored with an embedding of the description, and a new description is served
+the command of its nearest neighbour if they're similar enough. Entries are
+scoped (by the caller) to the machine's OS, shell and so on.
+
+Embeddings come from a local OpenAI-compatible /embeddings endpoint, so the
+cache is only used when an embedding model is configured (e.g.
+nomic-embed-text on Ollama); word overlap can't tell "older than 7 days" from
+"older than 30 days". Even a good model puts those close together, so a match
+is also refused unless both descriptions have the same numbers, paths and
+quoted strings.
+"""
+
+import array
+import json
+import math
+import os
+import re
+import sqlite3
+import time
+import urllib.request
+from dataclasses import dataclass
+from typing import List, Optional
+
+from qq.cache import cache_dir, normalize
+
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_MAX_ENTRIES = 5000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    scope TEXT NOT NULL,
+    embedder TEXT NOT NULL,
+    query TEXT NOT NULL,
+    command TEXT NOT NULL,
+    vector BLOB NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (scope, embedder, query)
+)
+"""
+
+# what a command is usually built around: "quoted strings", paths and names
+# with extensions (~/logs, *.py), and numbers
+_LITERAL = re.compile(r"""'[^']*'|"[^"]*"|[^\s'"]*[/~.][^\s'"]*[\w*]|\d+(?:\.\d+)?""")
+
+
+def literals(text: str) -> List[str]:
+    return sorted(_LITERAL.findall(text))
+
+
+class EndpointEmbedder:
+    """Embeddings from an OpenAI-compatible server, e.g. Ollama or llama.cpp"""
+
+    def __init__(self, url: str, model: str, timeout: float = 5):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.timeout = timeout
+        self.name = f"{model}@{self.url}"
+
+    def embed(self, text: str) -> List[float]:
+        req = urllib.request.Request(
+            f"{self.url}/embeddings",
+            data=json.dumps({"model": self.model, "input": text}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout) as response:
+            return json.load(response)["data"][0]["embedding"]
+
+
+def _unit(vector: List[float]) -> array.array:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return array.array("f", (x / norm for x in vector))
+
+
+@dataclass
+class Match:
+    query: str
+    command: str
+    similarity: float
+    created: float
+
+
+class SemanticCache:
+    def __init__(
+        self,
+        embedder,
+        path: Optional[str] = None,
+        threshold: float = DEFAULT_THRESHOLD,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        if path is None:
+            os.makedirs(cache_dir(), exist_ok=True)
+            path = os.path.join(cache_dir(), "semantic.sqlite")
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(_SCHEMA)
+
+    def embed(self, query: str) -> array.array:
+        return _unit(self.embedder.embed(normalize(query)))
+
+    def lookup(self, scope: str, query: str, vector: array.array) -> Optional[Match]:
+        """
+        The most similar earlier description in scope, if it clears the
+        threshold and asks for the same literals as query
+        """
+        wanted = literals(normalize(query))
+        best = None
+        for other_query, command, blob, created in self.db.execute(
+            "SELECT query, command, vector, created FROM generations"
+            " WHERE scope = ? AND embedder = ?",
+            (scope, self.embedder.name),
+        ):
+            other = array.array("f")
+            other.frombytes(blob)
+            if len(other) != len(vector):
+                continue
+            similarity = sum(a * b for a, b in zip(vector, other))
+            if similarity < self.threshold or literals(other_query) != wanted:
+                continue
+            if best is None or similarity > best.similarity:
+                best = Match(other_query, command, similarity, created)
+        return best
+
+    def put(self, scope: str, query: str, command: str, vector: array.array) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO generations"
+            " (scope, embedder, query, command, vector, created)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                scope,
+                self.embedder.name,
+                normalize(query),
+                command,
+                vector.tobytes(),
+                time.time(),
+            ),
+        )
+        self.db.execute(
+            "DELETE FROM generations WHERE rowid IN (SELECT rowid FROM generations"
+            " ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+
+def embedder(model: str, url: Optional[str] = None) -> EndpointEmbedder:
+    """An endpoint embedder for model, on url or else a discovered local server"""
+    if url is None:
+        from qq import local
+
+        url = local.discover().url
+    return EndpointEmbedder(url, model)
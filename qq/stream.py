@@ -0,0 +1,64 @@
+"""
+Incremental parsers for model output, fed one streamed chunk at a time.
+"""
+
+
+def _partial_suffix(text: str, tag: str) -> int:
+    """Length of the longest suffix of text that could be the start of tag"""
+    for k in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:k]):
+            return k
+    return 0
+
+
+class CommandParser:
+    """
+    Pick the text between <command> and </command> out of a token stream as
+    it arrives. feed() returns whatever command text became available with
+    that chunk; tags split across chunks are held back until they resolve.
+    """
+
+    OPEN = "<command>"
+    CLOSE = "</command>"
+
+    def __init__(self):
+        self.buffer = ""
+        self.opened = False
+        self.closed = False
+        self.command = ""
+
+    def feed(self, chunk: str) -> str:
+        if self.closed:
+            return ""
+        self.buffer += chunk
+
+        if not self.opened:
+            start = self.buffer.find(self.OPEN)
+            if start < 0:
+                keep = _partial_suffix(self.buffer, self.OPEN)
+                self.buffer = self.buffer[len(self.buffer) - keep :]
+                return ""
+            self.opened = True
+            self.buffer = self.buffer[start + len(self.OPEN) :]
+
+        end = self.buffer.find(self.CLOSE)
+        if end >= 0:
+            text = self.buffer[:end]
+            self.closed = True
+            self.buffer = ""
+        else:
+            keep = _partial_suffix(self.buffer, self.CLOSE)
+            text = self.buffer[: len(self.buffer) - keep]
+            self.buffer = self.buffer[len(self.buffer) - keep :]
+
+        # the model usually puts a newline after <command>, don't echo it
+        if not self.command:
+            text = text.lstrip()
+        self.command += text
+        return text
+
+    def result(self) -> str:
+        """The command so far, including anything held back at end of stream"""
+        if self.opened and not self.closed:
+            return (self.command + self.buffer).strip()
+        return self.command.strip()
@@ -0,0 +1,269 @@
+"""
+Precomputing explanations for commands in the shell history.
+
+Most `qq !!` runs are about commands already in ~/.zsh_history or
+~/.bash_history. `qq warm` (from cron, or whenever the machine is idle) ranks
+the commands there by how often and how recently they were run and how much
+there is to explain, and fills the explanation cache for the best of them, so
+the interactive run is a cache hit. It runs niced, a few requests at a time,
+and never spends more than --budget: each request reserves its worst case
+(full prompt plus the whole token budget) before it's sent.
+
+Options after `--` are passed to qq as for an interactive run (e.g. `-m`), since
+the cache key depends on them. Ones that can make several requests per command
+(--fragments, --quick, --race, --hedge) aren't allowed, as the worst case is per
+request, and neither is --offline, which makes none and caches nothing.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import shlex
+import sys
+from collections import Counter
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+from qq import batch, cache, metrics, offline
+
+# a run this many commands ago counts half as much as one just now
+HALF_LIFE = 500
+# first words not worth explaining
+SKIP = {"qq", "cd", "ls", "ll", "pwd", "clear", "exit", "history", "fg", "bg", "jobs"}
+
+
+def history_files() -> List[str]:
+    candidates = [
+        os.environ.get("HISTFILE"),
+        "~/.zsh_history",
+        "~/.bash_history",
+    ]
+    paths = []
+    for path in filter(None, candidates):
+        path = os.path.expanduser(path)
+        if os.path.isfile(path) and path not in paths:
+            paths.append(path)
+    return paths
+
+
+def read_history(path: str) -> Iterator[str]:
+    """Commands in a zsh (plain or extended) or bash history file, oldest first"""
+    with open(path, "rb") as fp:
+        data = fp.read()
+    # plain zsh history has no timestamps to tell it by
+    zsh = True if "zsh" in os.path.basename(path) else None
+    return batch.history_entries(batch.decode_history(data, zsh))
+
+
+def as_asked(command: str) -> str:
+    """
+    command the way qq would receive it: a single command through `qq !!` has
+    its quotes removed by the shell, anything with pipes or separators has to
+    be quoted whole
+    """
+    if len(offline.split(command)) > 1 or "\n" in command:
+        return command
+    try:
+        return " ".join(shlex.split(command))
+    except ValueError:
+        return command
+
+
+def complexity(command: str) -> int:
+    """Roughly how much there is to explain: words, counting operators double"""
+    try:
+        tokens = offline.tokenize(command)
+    except ValueError:
+        return 0
+    return len(tokens) + sum(token in offline.OPERATORS for token in tokens)
+
+
+def rank(commands: List[str]) -> List[Tuple[str, float]]:
+    """Distinct commands worth explaining, best first, with their scores"""
+    weights: Counter = Counter()
+    # the latest spelling of each, newlines and all
+    latest = {}
+    total = len(commands)
+    for i, command in enumerate(commands):
+        key = cache.normalize(command)
+        weights[key] += 0.5 ** ((total - 1 - i) / HALF_LIFE)
+        latest[key] = command
+
+    ranked = []
+    for key, weight in weights.items():
+        size = complexity(key)
+        if size < 2 or key.split(maxsplit=1)[0] in SKIP:
+            continue
+        ranked.append((latest[key], weight * (1 + math.log(size))))
+    ranked.sort(key=lambda item: -item[1])
+    return ranked
+
+
+@dataclass
+class Budget:
+    """Dollars that may be spent, with each request's worst case held back while it runs"""
+
+    limit: float
+    spent: float = 0.0
+    reserved: float = 0.0
+
+    def reserve(self, cost: float) -> bool:
+        if self.spent + self.reserved + cost > self.limit:
+            return False
+        self.reserved += cost
+        return True
+
+    def settle(self, reserved: float, cost: float) -> None:
+        self.reserved -= reserved
+        self.spent += cost
+
+
+def worst_case(model: str, messages, max_tokens: int) -> Optional[float]:
+    """Cost of the full prompt plus max_tokens of output, None if model isn't priced"""
+    from qq.engine import _load_litellm
+
+    litellm = _load_litellm()
+    try:
+        prompt = litellm.token_counter(model=model, messages=messages)
+        costs = litellm.cost_per_token(
+            model=model, prompt_tokens=prompt, completion_tokens=max_tokens
+        )
+    except Exception:
+        return None
+    return sum(costs)
+
+
+async def warm(commands: List[str], args, qq_args) -> dict:
+    from qq.main import _budget, _explain_request, _explain_source, build_engines
+
+    llm = build_engines(qq_args)["explain"]
+    store = cache.open_cache()
+    budget = Budget(args.budget)
+    counts = {"warmed": 0, "cached": 0, "failed": 0, "unpriced": 0}
+    semaphore = asyncio.Semaphore(max(1, args.jobs))
+    tasks = []
+
+    async def explain(query: str, reserved: float) -> None:
+        # the session is shared by every task, so its total won't do
+        with metrics.collect() as records:
+            try:
+                async with aclosing(_explain_source(llm, query, qq_args)) as stream:
+                    async for _ in stream:
+                        pass
+                counts["warmed"] += 1
+                if args.verbose:
+                    print(f"warmed: {query}", file=sys.stderr)
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"{query}: {e}", file=sys.stderr)
+            finally:
+                await asyncio.gather(*(record.settle() for record in records))
+                budget.settle(reserved, sum(record.cost for record in records))
+                semaphore.release()
+
+    for query in commands:
+        key, messages = _explain_request(query, qq_args, llm.model)
+        if store and store.has(key):
+            counts["cached"] += 1
+            continue
+        if qq_args.local in ("all", "explain"):
+            cost = 0.0
+        else:
+            cost = worst_case(llm.model, messages, _budget("explain", qq_args))
+        if cost is None:
+            # no price to hold it to, so the budget can't be kept
+            counts["unpriced"] += 1
+            continue
+        await semaphore.acquire()
+        if not budget.reserve(cost):
+            semaphore.release()
+            break
+        if args.dry_run:
+            print(f"${cost:.4f}  {query}")
+            budget.settle(cost, cost)
+            semaphore.release()
+            continue
+        tasks.append(asyncio.create_task(explain(query, cost)))
+
+    await asyncio.gather(*tasks)
+    counts["spent"] = budget.spent
+    return counts
+
+
+def main(argv) -> None:
+    """qq warm [--budget DOLLARS] [-- qq options]"""
+    parser = argparse.ArgumentParser(
+        prog="qq warm",
+        description="Precompute explanations for commands in your shell history",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0.05,
+        help="Most to spend in dollars, counting each request at its worst case (default 0.05)",
+    )
+    parser.add_argument(
+        "--limit", type=int, default=200, help="Consider only this many top commands"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=2, help="Maximum concurrent requests"
+    )
+    parser.add_argument(
+        "--history",
+        action="append",
+        help="History file to read (default: $HISTFILE, ~/.zsh_history, ~/.bash_history)",
+    )
+    parser.add_argument(
+        "--max-load",
+        type=float,
+        help="Do nothing if the 1-minute load average is above this",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="List what would be explained and its worst-case cost",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    argv = list(argv)
+    rest = []
+    if "--" in argv:
+        at = argv.index("--")
+        argv, rest = argv[:at], argv[at + 1 :]
+    args = parser.parse_args(argv)
+
+    if args.max_load is not None and os.getloadavg()[0] > args.max_load:
+        print("machine is busy, not warming", file=sys.stderr)
+        return
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+    from qq.main import build_parser
+
+    qq_args = build_parser().parse_args(rest)
+    if qq_args.fragments or qq_args.quick or qq_args.race or qq_args.hedge:
+        parser.error(
+            "--fragments, --quick, --race and --hedge can make several requests"
+            " per command, which --budget can't account for"
+        )
+    if qq_args.offline:
+        parser.error("--offline explanations aren't cached, so there's nothing to warm")
+
+    commands = []
+    for path in args.history or history_files():
+        commands.extend(read_history(path))
+    # two spellings can come out the same once the shell has had its way
+    queries = dict.fromkeys(as_asked(c) for c, _ in rank(commands)[: args.limit])
+
+    counts = asyncio.run(warm(list(queries), args, qq_args))
+    if args.dry_run:
+        print(f"would spend at most ${counts['spent']:.4f}")
+        return
+    print(
+        f"warmed {counts['warmed']}, {counts['cached']} already cached,"
+        f" {counts['failed']} failed, {counts['unpriced']} skipped (no price)"
+        f" for ${counts['spent']:.4f}"
+    )